@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""Catalog of tables in many files, read as one table.
+
+Files matching a glob pattern, or all files in a directory, are scanned once.
+Schema, number of rows and chunk layout of each file are cached in a sidecar
+catalog file, and rescanned only when the file changes. Global row numbers
+are mapped to (file, local row) by binary search over cumulative row counts,
+and files are opened only when rows in them are read. All files must have the
+same schema, including labels of categorical columns and jagged columns.
+
+Syntax:
+  catalog.py [options] pattern[:table_name]
+
+Options:
+  -h  print this message.
+  -c  catalog file (default: .tabio_catalog.json in the common directory of files).
+  -r  rescan all files.
+
+"""
+import os
+import sys
+import json
+import numpy as np
+from os import path
+from glob import glob
+from getopt import gnu_getopt
+from collections import OrderedDict
+from tabio import table, open_table, detect_format, backends, output_buffer, categories_to_json, categories_from_json, concatenate_jagged
+from chunkcache import default_cache
+
+catalog_name = '.tabio_catalog.json'
+default_max_open = 16
+
+def match_files(pattern):
+    """Files matching glob pattern or in directory pattern.
+
+    Their formats are detected by scan, only if they are not in the catalog.
+    """
+    if path.isdir(pattern):
+        fnames = [path.join(pattern, f) for f in os.listdir(pattern) if not f.startswith('.')]
+    else:
+        fnames = glob(pattern)
+    return sorted(path.realpath(f) for f in fnames if path.isfile(f) or path.isdir(f))
+
+class dataset_catalog(table):
+    def __init__(self, pattern, tname, catalog=None, rescan=False, cache=default_cache, max_open=default_max_open):
+        """Catalog of table tname in files matching pattern.
+
+        pattern  - glob pattern or directory.
+        catalog  - sidecar catalog file.
+        rescan   - rescan all files instead of using cached entries.
+        max_open - maximum number of files kept open.
+        """
+        self.pattern  = pattern
+        self.tname    = tname
+        self.cache    = cache
+        self.max_open = max_open
+        self.opened   = OrderedDict()
+        fnames = match_files(pattern)
+        if len(fnames) == 0:
+            raise IOError(u'no file matches {}.'.format(pattern))
+        if catalog is None:
+            catalog = path.join(path.commonpath([path.dirname(f) for f in fnames]), catalog_name)
+        self.catalog = catalog
+        self.fnames, self.entries = self.scan(fnames, rescan)
+        if len(self.fnames) == 0:
+            raise IOError(u'no file of supported format matches {}.'.format(pattern))
+        first = self.entries[0]
+        for fname, entry in zip(self.fnames, self.entries):
+            if any(entry[k] != first[k] for k in ['dtype', 'categories', 'jagged']):
+                raise TypeError(u'schema of {}:{} differs from {}:{}.'.format(fname, tname, self.fnames[0], tname))
+        self.dtype   = np.dtype([tuple(f) for f in first['dtype']])
+        self.categories = categories_from_json(first['categories'])
+        self.jagged  = dict((cname, np.dtype(t)) for cname, t in first['jagged'].items())
+        self.rowsize = self.dtype.itemsize
+        self.cols    = dict((cname, None) for cname in self.dtype.names)
+        self.offsets = np.cumsum([0]+[entry['nrows'] for entry in self.entries])
+        self.nrows   = int(self.offsets[-1])
+
+    def scan(self, fnames, rescan=False):
+        """Files of supported formats among fnames and their catalog entries.
+
+        Only files that are new or changed are opened, files of unsupported
+        formats are cataloged as such, so that they are not opened again.
+        """
+        try:
+            with open(self.catalog, 'r') as fp:
+                cached = json.load(fp)
+        except (IOError, ValueError):
+            cached = {}
+        matched = []
+        entries = []
+        changed = False
+        for fname in fnames:
+            st  = os.stat(fname)
+            key = u'{}:{}'.format(fname, self.tname)
+            entry = cached.get(key)
+            if rescan or entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size or 'jagged' not in entry:
+                fmt = detect_format(fname)
+                if fmt not in backends:
+                    cached[key] = {'mtime':st.st_mtime, 'size':st.st_size, 'format':None, 'jagged':None}
+                    changed = True
+                    continue
+                tab = open_table(fname, self.tname, cache=None)
+                chunklen = [(cname, tab.chunklen(cname)) for cname in tab.dtype.names]
+                entry = {
+                    'mtime'   :st.st_mtime,
+                    'size'    :st.st_size,
+                    'format'  :fmt,
+                    # dtype strings drop metadata, e.g., of h5py string dtypes.
+                    'dtype'   :[[cname, tab.dtype[cname].str] for cname in tab.dtype.names],
+                    'categories':categories_to_json(tab.categories),
+                    'jagged'  :dict((cname, t.str) for cname, t in tab.jagged.items()),
+                    'nrows'   :int(tab.nrows),
+                    'chunklen':dict((cname, None if n is None else int(n)) for cname, n in chunklen)
+                }
+                tab.close()
+                cached[key] = entry
+                changed = True
+            if entry['format'] not in backends:
+                continue
+            matched.append(fname)
+            entries.append(entry)
+        if changed:
+            tmp = u'{}.{:d}'.format(self.catalog, os.getpid())
+            with open(tmp, 'w') as fp:
+                json.dump(cached, fp)
+            os.replace(tmp, self.catalog)
+        return matched, entries
+
+    def open_file(self, i):
+        """Table in i-th file, opened on demand and kept among the most recently used.
+        """
+        if i in self.opened:
+            self.opened.move_to_end(i)
+            return self.opened[i]
+        tab = backends[self.entries[i]['format']](self.fnames[i], self.tname, cache=self.cache)
+        self.opened[i] = tab
+        while len(self.opened) > self.max_open:
+            _, old = self.opened.popitem(last=False)
+            old.close()
+        return tab
+
+    def locate(self, rows):
+        """Map global row numbers to file numbers and local row numbers.
+        """
+        rows = np.asarray(rows, dtype='int64')
+        i = np.searchsorted(self.offsets, rows, side='right') - 1
+        return i, rows - self.offsets[i]
+
+    def file_slices(self, start, stop, step):
+        """Iterate over (file number, local start, local stop) of rows start:stop:step, step > 0.
+
+        Only files overlapping start:stop are visited.
+        """
+        if stop <= start:
+            return
+        for i in range(int(self.locate(start)[0]), int(self.locate(stop-1)[0])+1):
+            f0, f1 = self.offsets[i], self.offsets[i+1]
+            lo = start + -(-(max(start, f0)-start)//step)*step
+            hi = min(stop, f1)
+            if lo < hi:
+                yield i, int(lo-f0), int(hi-f0)
+
+    def load(self, key, start, stop, step=1):
+        """Read rows start:stop:step of column key from the files they are in.
+        """
+        if step < 0:
+            rows = np.arange(start, stop, step)
+            if rows.size == 0:
+                return np.empty(0, dtype=self.dtype[key])
+            return self.load(key, int(rows[-1]), int(rows[0])+1, -step)[::-1]
+        col = np.empty(len(range(start, stop, step)), dtype=self.dtype[key])
+        k = 0
+        for i, lo, hi in self.file_slices(start, stop, step):
+            part = self.open_file(i).read_column(key, lo, hi, step)
+            col[k:k+part.size] = part
+            k += part.size
+        return col
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        start, stop, step = slice(start, stop, step).indices(self.nrows)
+        arr = output_buffer(out, len(range(start, stop, step)), self.dtype)
+        if step < 0 or arr.size == 0:
+            if step < 0:
+                arr[...] = self.take(np.arange(start, stop, step))
+            return arr
+        # each file reads into its slice of arr.
+        k = 0
+        for i, lo, hi in self.file_slices(start, stop, step):
+            rows = self.open_file(i).read(lo, hi, step, out=arr[k:])
+            k += rows.size
+        return arr
+
+    def take(self, indices):
+        rows, inverse = self.unique_rows(indices)
+        arr = np.empty(rows.size, dtype=self.dtype)
+        ids, local = self.locate(rows)
+        ends = np.append(np.flatnonzero(np.diff(ids))+1, rows.size)
+        k = 0
+        for j in ends:
+            arr[k:j] = self.open_file(int(ids[k])).take(local[k:j])
+            k = j
+        return arr[inverse]
+
+    def load_jagged(self, key, start, stop):
+        if stop <= start:
+            return concatenate_jagged([], self.jagged[key])
+        parts = [self.open_file(i).read_jagged(key, lo, hi) for i, lo, hi in self.file_slices(start, stop, 1)]
+        return concatenate_jagged(parts, self.jagged[key])
+
+    def close(self):
+        for tab in self.opened.values():
+            tab.close()
+        self.opened.clear()
+
+if __name__ == '__main__':
+    opts, args = gnu_getopt(sys.argv[1:], 'hc:r')
+    catalog = None
+    rescan  = False
+    for opt, val in opts:
+        if opt == '-h':
+            print(__doc__)
+            sys.exit()
+        elif opt == '-c':
+            catalog = val
+        elif opt == '-r':
+            rescan = True
+    try:
+        pattern, tname = args[0].split(':')
+    except ValueError:
+        pattern, tname = args[0], '/'
+    cat = dataset_catalog(pattern, tname, catalog=catalog, rescan=rescan)
+    print(u'{:d} files, {:d} rows, catalog saved to {}.'.format(len(cat.fnames), cat.nrows, cat.catalog))
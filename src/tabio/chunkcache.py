@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""Process-wide cache of decompressed column chunks.
+
+Chunks are keyed by (file, dataset, chunk index) and shared by all table
+objects of the process, so that revisiting a region of a table through any
+handle decompresses each chunk only once. The cache holds at most a fixed
+number of bytes and evicts the least recently used chunks first.
+"""
+import threading
+import numpy as np
+from os import path, stat
+from collections import OrderedDict
+
+default_cache_size_bytes = 512*1024**2
+default_chunk_size_bytes = 1024**2
+
+class chunk_cache(object):
+    def __init__(self, nbytes_max=default_cache_size_bytes):
+        """Least recently used cache of decompressed chunks.
+
+        nbytes_max - byte budget of the cache.
+        """
+        self.nbytes_max = int(nbytes_max)
+        self.nbytes     = 0
+        self.chunks     = OrderedDict()
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self.lock       = threading.RLock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __contains__(self, key):
+        return key in self.chunks
+
+    def get(self, key, load):
+        """Return chunk of key, calling load() to decompress it on a miss.
+
+        Chunks returned are shared by all readers, hence read-only.
+        """
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                self.chunks.move_to_end(key)
+                self.hits += 1
+                return chunk
+            self.misses += 1
+        chunk = load()
+        self.put(key, chunk)
+        return chunk
+
+    def put(self, key, chunk):
+        chunk = np.asarray(chunk)
+        chunk.flags.writeable = False
+        with self.lock:
+            self.discard(key)
+            if chunk.nbytes > self.nbytes_max:
+                return
+            self.chunks[key] = chunk
+            self.nbytes += chunk.nbytes
+            self.evict()
+
+    def discard(self, key):
+        with self.lock:
+            chunk = self.chunks.pop(key, None)
+            if chunk is not None:
+                self.nbytes -= chunk.nbytes
+
+    def evict(self):
+        with self.lock:
+            while self.nbytes > self.nbytes_max:
+                _, chunk = self.chunks.popitem(last=False)
+                self.nbytes -= chunk.nbytes
+                self.evictions += 1
+
+    def resize(self, nbytes_max):
+        with self.lock:
+            self.nbytes_max = int(nbytes_max)
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'chunks'    :len(self.chunks),
+                'nbytes'    :self.nbytes,
+                'nbytes_max':self.nbytes_max,
+                'hits'      :self.hits,
+                'misses'    :self.misses,
+                'evictions' :self.evictions
+            }
+
+default_cache = chunk_cache()
+
+def set_cache_size(nbytes_max):
+    """Set byte budget of the process-wide chunk cache.
+    """
+    default_cache.resize(nbytes_max)
+
+def file_key(fname):
+    """Identity of a file in chunk keys.
+
+    The modification time tells apart different generations of the same path.
+    """
+    fname = path.realpath(fname)
+    try:
+        return (fname, stat(fname).st_mtime)
+    except OSError:
+        return (fname, None)
+
+def chunk_rows(chunklen, start, stop, step, i):
+    """Rows start:stop:step that fall in the i-th chunk, relative to the chunk.
+    """
+    c0 = i*chunklen
+    lo = max(start, c0)
+    lo = start + -(-(lo-start)//step)*step
+    hi = min(stop, c0+chunklen)
+    return slice(lo-c0, max(lo, hi)-c0, step)
+
+def read_chunks(cache, key, chunklen, nrows, load, start, stop, step=1):
+    """Read rows start:stop:step of a chunked column through cache.
+
+    key      - (file, dataset) identity of the column.
+    chunklen - number of rows per chunk.
+    nrows    - number of rows of the column.
+    load     - load(start, stop) reads rows start:stop of the column.
+    """
+    if stop <= start:
+        return load(start, start)
+    parts = []
+    for i in range(start//chunklen, (stop-1)//chunklen+1):
+        c0 = i*chunklen
+        s  = chunk_rows(chunklen, start, stop, step, i)
+        if s.start < s.stop:
+            chunk = cache.get(key+(i,), lambda: load(c0, min(c0+chunklen, nrows)))
+            parts.append(chunk[s])
+    if len(parts) == 1:
+        return parts[0].copy()
+    return np.concatenate(parts)
+
+def discard_chunks(cache, key, chunklen, start, stop):
+    """Invalidate cached chunks of rows start:stop, e.g., after they are written.
+    """
+    if cache is None or stop <= start:
+        return
+    for i in range(start//chunklen, (stop-1)//chunklen+1):
+        cache.discard(key+(i,))
+
+def take_chunks(cache, key, chunklen, nrows, load, rows):
+    """Read rows of a chunked column, decompressing each chunk once.
+
+    rows - sorted, unique row numbers.
+    load - load(start, stop) reads rows start:stop of the column.
+
+    Rows are grouped by chunk, each chunk is loaded (through cache unless it
+    is None) and the rows it holds are gathered in one vectorized step.
+    """
+    rows = np.asarray(rows, dtype='int64')
+    if rows.size == 0:
+        return load(0, 0)
+    ids  = rows//chunklen
+    ends = np.append(np.flatnonzero(np.diff(ids))+1, rows.size)
+    parts = []
+    k = 0
+    for j in ends:
+        i  = int(ids[k])
+        c0 = i*chunklen
+        c1 = min(c0+chunklen, nrows)
+        if cache is None:
+            chunk = load(c0, c1)
+        else:
+            chunk = cache.get(key+(i,), lambda: load(c0, c1))
+        parts.append(chunk[rows[k:j]-c0])
+        k = j
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""Aggregate table by group-by columns in one read-only pass.
+
+Syntax:
+  h5agg.py [options] source_file:/table_name [dest_file:/table_name]
+
+Source table can be in any format supported by tabio. Result is printed, and
+saved to dest_file:/table_name as PyTables table if it is specified.
+
+Options:
+  -h  print this message.
+  -e  selection expression.
+  -g  group-by columns, comma separated.
+  -a  aggregate expressions, comma separated (default: count). Supported:
+      count
+      sum(EXPR), mean(EXPR), min(EXPR), max(EXPR)
+      hist(EXPR,LOW,HIGH,NBINS)  fixed-bin histogram.
+      EXPR is an expression of columns, e.g., sum(px**2+py**2).
+  -n  number of processes (default: number of cores).
+  -b  chunksize in bytes, suffix as 'k', 'm' and 'g' are supported.
+
+"""
+import re
+import sys
+import numpy as np
+from os import path
+from getopt import gnu_getopt
+from multiprocessing import cpu_count
+from tabio import open_table, evaluate, select_rows, decode_categories, parallel_scan
+
+def split_arguments(s):
+    """Split s at commas outside of parentheses.
+    """
+    parts, depth, k = [], 0, 0
+    for i, c in enumerate(s):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(s[k:i].strip())
+            k = i+1
+    parts.append(s[k:].strip())
+    return [p for p in parts if p]
+
+def parse_aggregates(aggregates):
+    """Parse aggregate expressions.
+
+    Returns list of (name, function, expression, arguments). Names are made of
+    the function, the expression and the histogram bins, aggregates whose
+    names are equal are rejected.
+    """
+    if isinstance(aggregates, str):
+        aggregates = split_arguments(aggregates)
+    aggs = []
+    for agg in aggregates:
+        m = re.match(r'^\s*(\w+)\s*(?:\((.*)\))?\s*$', agg)
+        if m is None:
+            raise ValueError(u'unrecognized aggregate {}.'.format(agg))
+        func, args = m.group(1).lower(), m.group(2)
+        if func == 'count':
+            name = 'count'
+            if name in [a[0] for a in aggs]:
+                raise ValueError(u'aggregate {} occurs more than once.'.format(agg))
+            aggs.append((name, 'count', None, ()))
+            continue
+        if func not in ['sum', 'mean', 'min', 'max', 'hist'] or not args:
+            raise ValueError(u'unsupported aggregate {}.'.format(agg))
+        args = split_arguments(args)
+        expr, args = args[0], args[1:]
+        name = re.sub(r'\W+', '_', '_'.join([func, expr]+args)).strip('_')
+        if func == 'hist':
+            args = (float(args[0]), float(args[1]), int(args[2]))
+        if name in [a[0] for a in aggs]:
+            raise ValueError(u'aggregate {} clashes with another aggregate named {}.'.format(agg, name))
+        aggs.append((name, func, expr, tuple(args)))
+    return aggs
+
+def group_keys(rows, by):
+    """Sorted unique keys of rows and group number of each row.
+    """
+    if not by:
+        return None, np.zeros(rows.size, dtype='int64')
+    if len(by) == 1:
+        keys = rows[by[0]]
+    else:
+        keys = np.empty(rows.size, dtype=[(k, rows.dtype[k]) for k in by])
+        for k in by:
+            keys[k] = rows[k]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, inverse.ravel()
+
+def partial_aggregate(rows, by, aggs):
+    """Partial aggregates of a chunk of rows.
+
+    Returns (keys, states), where states maps each aggregate to its per-group
+    state: counts and sums are additive, minima and maxima are merged with
+    np.minimum and np.maximum, histograms are per-group bin counts.
+    """
+    keys, inverse = group_keys(rows, by)
+    ngroups = 1 if keys is None else keys.size
+    states = {'count':np.bincount(inverse, minlength=ngroups)}
+    for name, func, expr, args in aggs:
+        if func == 'count':
+            continue
+        x = np.broadcast_to(evaluate(rows, expr), (rows.size,))
+        if func in ['sum', 'mean']:
+            states[name] = np.bincount(inverse, weights=x, minlength=ngroups)
+        elif func == 'min':
+            states[name] = np.full(ngroups, np.inf)
+            np.minimum.at(states[name], inverse, x)
+        elif func == 'max':
+            states[name] = np.full(ngroups, -np.inf)
+            np.maximum.at(states[name], inverse, x)
+        elif func == 'hist':
+            low, high, nbins = args
+            b = np.floor((x-low)*(nbins/(high-low))).astype('int64')
+            inside = (b >= 0) & (b < nbins)
+            states[name] = np.bincount(inverse[inside]*nbins+b[inside], minlength=ngroups*nbins).reshape((ngroups, nbins))
+    return keys, states
+
+def merge_aggregates(partials, aggs):
+    """Merge partial aggregates of chunks into one.
+    """
+    partials = [p for p in partials if p[1] is not None and p[1]['count'].size > 0]
+    if len(partials) == 0:
+        return None, None
+    if len(partials) == 1:
+        return partials[0]
+    if partials[0][0] is None:
+        keys, inverse, ngroups = None, np.zeros(len(partials), dtype='int64'), 1
+    else:
+        keys, inverse = np.unique(np.concatenate([p[0] for p in partials]), return_inverse=True)
+        inverse, ngroups = inverse.ravel(), keys.size
+    states = {}
+    for name in partials[0][1]:
+        state = np.concatenate([p[1][name] for p in partials])
+        func  = name.split('_')[0]
+        if func == 'min':
+            states[name] = np.full(ngroups, np.inf)
+            np.minimum.at(states[name], inverse, state)
+        elif func == 'max':
+            states[name] = np.full(ngroups, -np.inf)
+            np.maximum.at(states[name], inverse, state)
+        else:
+            states[name] = np.zeros((ngroups,)+state.shape[1:], dtype=state.dtype)
+            np.add.at(states[name], inverse, state)
+    return keys, states
+
+def finalize_aggregates(keys, states, by, aggs, dtype):
+    """Structured array of group-by columns followed by aggregates.
+    """
+    fields = [(k, dtype[k]) for k in by]
+    for name, func, expr, args in aggs:
+        if func == 'count':
+            fields.append((name, 'int64'))
+        elif func == 'hist':
+            fields.append((name, 'int64', (args[2],)))
+        else:
+            fields.append((name, 'float64'))
+    if states is None:
+        return np.empty(0, dtype=fields)
+    result = np.empty(states['count'].size, dtype=fields)
+    for k in by:
+        result[k] = keys if len(by) == 1 else keys[k]
+    for name, func, expr, args in aggs:
+        if func == 'count':
+            result[name] = states['count']
+        elif func == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[name] = states[name] / states['count']
+        else:
+            result[name] = states[name]
+    return result
+
+def aggregate_chunks(tab, chunks, params):
+    """Partial aggregates of chunks of rows (see tabio.parallel_scan).
+    """
+    selection, by, aggs = params
+    partials = []
+    for _, rows in chunks:
+        partials.append(partial_aggregate(select_rows(rows, selection, tab.categories), by, aggs))
+    return merge_aggregates(partials, aggs)
+
+def aggregate_table(source, by=None, aggregates=('count',), selection=None, nprocs=None, chunksize=None):
+    """Aggregate table by group-by columns.
+
+    source     - source_file:/table_name, in any format supported by tabio.
+    by         - list of group-by columns, None to aggregate all rows.
+    aggregates - list of aggregate expressions (see parse_aggregates).
+    selection  - selection expression applied before aggregating.
+    nprocs     - number of processes.
+    chunksize  - chunksize in bytes.
+
+    Each process reads disjoint row ranges and computes vectorized partial
+    aggregates per chunk, the partials are then merged, so that memory is
+    proportional to the number of groups instead of the number of rows.
+    """
+    file_in, node_in = source.split(':')
+    by   = list(by or [])
+    aggs = parse_aggregates(aggregates)
+    tab_in = open_table(file_in, node_in, cache=None)
+    dtype = tab_in.dtype
+    categories = dict((k, tab_in.categories[k]) for k in by if k in tab_in.categories)
+    tab_in.close()
+    if nprocs is None:
+        nprocs = cpu_count()
+    partials = []
+    for partial in parallel_scan(file_in, node_in, aggregate_chunks, (selection, by, aggs), nprocs=nprocs, chunksize=chunksize, title='Aggregating table'):
+        partials.append(partial)
+        if len(partials) > nprocs:
+            partials = [merge_aggregates(partials, aggs)]
+    keys, states = merge_aggregates(partials, aggs)
+    # group-by categorical columns are returned as labels.
+    return decode_categories(finalize_aggregates(keys, states, by, aggs, dtype), categories)
+
+def print_aggregates(result):
+    names = result.dtype.names
+    print(u' | '.join(u'{:>15}'.format(n) for n in names))
+    print(u'{:-^80}'.format(''))
+    for r in result:
+        print(u' | '.join(u'{:>15}'.format(str(r[n])) for n in names))
+
+if __name__ == '__main__':
+    opts, args = gnu_getopt(sys.argv[1:], 'he:g:a:n:b:')
+    selection  = None
+    by         = None
+    aggregates = 'count'
+    nprocs     = None
+    chunksize  = None
+    for opt, val in opts:
+        if opt == '-h':
+            print(__doc__)
+            sys.exit()
+        elif opt == '-e':
+            selection = val
+        elif opt == '-g':
+            by = val.split(',')
+        elif opt == '-a':
+            aggregates = val
+        elif opt == '-n':
+            nprocs = int(val)
+        elif opt == '-b':
+            if val.lower().endswith('k'):
+                chunksize = int(int(val[:-1]) * 1024)
+            elif val.lower().endswith('m'):
+                chunksize = int(int(val[:-1]) * 1024**2)
+            elif val.lower().endswith('g'):
+                chunksize = int(int(val[:-1]) * 1024**3)
+            else:
+                chunksize = int(val)
+    source = args[0]
+    result = aggregate_table(source, by=by, aggregates=aggregates, selection=selection, nprocs=nprocs, chunksize=chunksize)
+    print_aggregates(result)
+    if len(args) > 1:
+        import tables
+        file_out, node_out = args[1].split(':')
+        grpname, tabname = path.split(node_out)
+        with tables.open_file(file_out, 'a') as h5_out:
+            h5_out.create_table(grpname, tabname, result, createparents=True)
+        print(u'Aggregates saved to {}:{}.'.format(file_out, node_out))
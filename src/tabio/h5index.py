@@ -5,10 +5,15 @@
 Syntax:
   h5index.py options h5file:/table
 
+Tables of PyTables files get a PyTables CSI. Tables of other HDF5 files, i.e.,
+groups of column datasets written by tabio, get a tabio sorted index built by
+a pool of processes (see tabio.create_sorted_index).
+
 Options:
   -h  print this message.
   -c  name of column to be indexed.
   -t  name of column to test.
+  -n  number of processes building tabio sorted indexes (default: number of cores).
 
 """
 import sys
@@ -17,10 +22,18 @@ import numpy as np
 from time import time
 from getopt import gnu_getopt
 from signal import signal, SIGINT
+from tabio import hdf5_table, create_sorted_index
 
-def create_index(h5path, colname):
+def create_index(h5path, colname, nprocs=None):
     h5file, h5node = h5path.split(':')
-    assert tables.is_pytables_file(h5file)
+    if not tables.is_pytables_file(h5file):
+        sys.stdout.write(u'    Creating sorted index for column {} of {}:{}......'.format(colname, h5file, h5node))
+        sys.stdout.flush()
+        tic = time()
+        create_sorted_index(h5file, h5node, colname, nprocs=nprocs)
+        sys.stdout.write(u'\r    Creating sorted index for column {} of {}:{}......OK ({:.2f} seconds).\n'.format(colname, h5file, h5node, time()-tic))
+        sys.stdout.flush()
+        return
     with tables.open_file(h5file, 'a') as h5:
         tab = h5.get_node(h5node)
         sys.stdout.write(u'    Creating completely sorted index (CSI) for column {} of {}:{}......'.format(colname, h5file, h5node))
@@ -31,10 +44,14 @@ def create_index(h5path, colname):
 
 def test_index(h5path, colname):
     h5file, h5node = h5path.split(':')
-    assert tables.is_pytables_file(h5file)
-    with tables.open_file(h5file, 'r') as h5:
+    if tables.is_pytables_file(h5file):
+        h5 = tables.open_file(h5file, 'r')
         tab = h5.get_node(h5node)
         assert getattr(tab.cols, colname).is_indexed, 'column `'+colname+'` is not indexed.'
+    else:
+        h5 = tab = hdf5_table(fname=h5file, tname=h5node, mode='r')
+        assert tab.is_indexed(colname), 'column `'+colname+'` is not indexed.'
+    try:
         print('`{}` has been indexed.'.format(colname))
         print('Random I/O performance test (Press Ctrl+C to abort):')
         buf = np.empty((1,), dtype=tab.dtype)
@@ -46,6 +63,8 @@ def test_index(h5path, colname):
             t += 1
             sys.stdout.write(u'\r  {:d} rows copied ({:.1f} Rows/s, {:.2f} KiB/s)......'.format(t, t/(time()-tic), 1e-3*tab.rowsize*t/(time()-tic)))
             sys.stdout.flush()
+    finally:
+        h5.close()
 
 def handler(signal_rcvd, frame):
     print('\nAbort. Goodbye!')
@@ -53,16 +72,22 @@ def handler(signal_rcvd, frame):
 
 if __name__ == '__main__':
     signal(SIGINT, handler)
-    opts, args = gnu_getopt(sys.argv[1:], 'hc:t:')
+    opts, args = gnu_getopt(sys.argv[1:], 'hc:t:n:')
+    nprocs = None
+    create = None
+    test   = None
     for opt, val in opts:
         if opt == '-h':
             print(__doc__)
             sys.exit()
         elif opt == '-c':
-            colname = val
-            h5path = args[0]
-            create_index(h5path, colname)
+            create = val
         elif opt == '-t':
-            colname = val
-            h5path = args[0]
-            test_index(h5path, colname)
+            test = val
+        elif opt == '-n':
+            nprocs = int(val)
+    h5path = args[0]
+    if create is not None:
+        create_index(h5path, create, nprocs=nprocs)
+    if test is not None:
+        test_index(h5path, test)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""Join two tables sorted by key columns and save joined rows to specified container.
+
+Syntax:
+  h5join.py [options] left_file:/table_name right_file:/table_name dest_file:/table_name
+
+Both tables must be sorted by the key columns in ascending order, e.g., output
+of h5sort.py, or have a completely sorted index on the (single) key column
+(see -i). Tables are streamed in chunks and merged, so memory does not grow
+with the size of the tables but with the longest run of equal keys.
+
+Options:
+  -h  print this message.
+  -k  key columns, comma separated.
+  -t  join type: inner (default) or left.
+  -i  read tables in order of their completely sorted index on the key column.
+  -s  suffix of right columns whose names clash with left columns (default: _r).
+  -f  output format (see tabio.py, default: HDF5).
+  -m  output mode (see tabio.py, default: create).
+  -b  chunksize in bytes, suffix as 'k', 'm' and 'g' are supported.
+
+"""
+import sys
+import numpy as np
+from time import time
+from getopt import gnu_getopt
+from tabio import open_table, create_table, default_buffer_size_bytes
+
+def key_dtype(dtype_left, dtype_right, keys):
+    """Common dtype of keys of both tables.
+    """
+    if len(keys) == 1:
+        return np.result_type(dtype_left[keys[0]], dtype_right[keys[0]])
+    return np.dtype([(k, np.result_type(dtype_left[k], dtype_right[k])) for k in keys])
+
+def key_array(rows, keys, dtype):
+    """Keys of rows as a plain array, or a packed structured array for compound keys.
+    """
+    if len(keys) == 1:
+        return rows[keys[0]].astype(dtype, copy=False)
+    k = np.empty(rows.size, dtype=dtype)
+    for name in keys:
+        k[name] = rows[name]
+    return k
+
+def key_less(a, b):
+    """a < b for single keys a and b, given as 1-element arrays.
+
+    searchsorted orders compound keys lexicographically, unlike comparison
+    operators which are not defined for structured arrays.
+    """
+    return np.searchsorted(b, a, side='right')[0] == 0
+
+def is_sorted(k):
+    """Whether keys k never decrease.
+
+    Compound keys are sorted if their stable lexicographic sort is the identity.
+    """
+    if k.dtype.names is None:
+        return bool(np.all(k[:-1] <= k[1:]))
+    return bool(np.all(np.lexsort([k[n] for n in reversed(k.dtype.names)]) == np.arange(k.size)))
+
+def joined_dtype(dtype_left, dtype_right, keys, suffix='_r'):
+    """dtype of joined rows and names of right columns in it.
+    """
+    fields = [(name, dtype_left[name]) for name in dtype_left.names]
+    rnames = {}
+    for name in dtype_right.names:
+        if name in keys:
+            continue
+        rnames[name] = name+suffix if name in dtype_left.names else name
+        fields.append((rnames[name], dtype_right[name]))
+    return np.dtype(fields), rnames
+
+def sorted_chunks(tab, keys, chunksize, by_index=False):
+    """Iterate over chunks of table in ascending order of keys.
+    """
+    if by_index:
+        for t in range(0, tab.nrows, chunksize):
+            yield tab.read_sorted(keys[0], start=t, stop=min(tab.nrows, t+chunksize))
+    else:
+        for _, rows in tab.iter_chunks(chunksize=chunksize):
+            yield rows
+
+def keyed_chunks(chunks, keys, kdtype, side):
+    """Iterate over (rows, keys) of chunks, checking that keys never decrease.
+    """
+    last = None
+    for rows in chunks:
+        k = key_array(rows, keys, kdtype)
+        if k.size == 0:
+            continue
+        if not is_sorted(k) or (last is not None and key_less(k[:1], last)):
+            raise ValueError(u'{} table is not sorted by {}.'.format(side, ','.join(keys)))
+        last = k[-1:]
+        yield rows, k
+
+def join_sorted(left, right, lk, rk, dtype, rnames, how='inner'):
+    """Join rows of left and right whose keys, lk and rk, are sorted and complete.
+
+    Many-to-many matches are expanded with vectorized searchsorted and repeat.
+    Unmatched rows of a left join have right columns of NaN or zero.
+    """
+    lo  = np.searchsorted(rk, lk, side='left')
+    cnt = np.searchsorted(rk, lk, side='right') - lo
+    if how == 'left':
+        hit = cnt > 0
+        cnt = np.maximum(cnt, 1)
+    n  = int(cnt.sum())
+    li = np.repeat(np.arange(lk.size), cnt)
+    ri = np.repeat(lo - np.cumsum(cnt) + cnt, cnt) + np.arange(n)
+    out = np.zeros(n, dtype=dtype)
+    for name in left.dtype.names:
+        out[name] = left[name][li]
+    if how == 'left':
+        hit = hit[li]
+        ri  = ri[hit]
+        for name, rname in rnames.items():
+            if out.dtype[rname].kind in 'fc':
+                out[rname] = np.nan
+            out[rname][hit] = right[name][ri]
+    else:
+        for name, rname in rnames.items():
+            out[rname] = right[name][ri]
+    return out
+
+def merge_join(left_chunks, right_chunks, dtype_left, dtype_right, keys, how='inner', suffix='_r'):
+    """Sort-merge join of two streams of chunks sorted by keys.
+
+    Rows with keys below the smallest last buffered key of the streams have all
+    their matches buffered, so they are joined and dropped. Streams whose last
+    buffered key equals that bound are then refilled with their next chunk.
+
+    Yields chunks of joined rows.
+    """
+    if how not in ['inner', 'left']:
+        raise ValueError(u'unsupported join type {}.'.format(how))
+    kdtype = key_dtype(dtype_left, dtype_right, keys)
+    dtype, rnames = joined_dtype(dtype_left, dtype_right, keys, suffix)
+    streams = [keyed_chunks(left_chunks, keys, kdtype, 'left'), keyed_chunks(right_chunks, keys, kdtype, 'right')]
+    bufs = [(np.empty(0, dtype=dtype_left), np.empty(0, dtype=kdtype)), (np.empty(0, dtype=dtype_right), np.empty(0, dtype=kdtype))]
+    done = [False, False]
+    def refill(i):
+        try:
+            rows, k = next(streams[i])
+        except StopIteration:
+            done[i] = True
+            return
+        bufs[i] = (np.concatenate([bufs[i][0], rows]), np.concatenate([bufs[i][1], k]))
+    while not (done[0] and done[1]):
+        empty = [i for i in (0, 1) if not done[i] and bufs[i][1].size == 0]
+        if empty:
+            for i in empty:
+                refill(i)
+            continue
+        if done[0] and bufs[0][1].size == 0:
+            return
+        bound = None
+        for i in (0, 1):
+            if not done[i] and (bound is None or key_less(bufs[i][1][-1:], bound)):
+                bound = bufs[i][1][-1:]
+        (left, lk), (right, rk) = bufs
+        lcut = int(np.searchsorted(lk, bound, side='left')[0])
+        rcut = int(np.searchsorted(rk, bound, side='left')[0])
+        if lcut > 0:
+            yield join_sorted(left[:lcut], right[:rcut], lk[:lcut], rk[:rcut], dtype, rnames, how)
+        bufs = [(left[lcut:], lk[lcut:]), (right[rcut:], rk[rcut:])]
+        for i in (0, 1):
+            if not done[i] and not key_less(bound, bufs[i][1][-1:]):
+                refill(i)
+    (left, lk), (right, rk) = bufs
+    if lk.size > 0:
+        yield join_sorted(left, right, lk, rk, dtype, rnames, how)
+
+def join_tables(left, right, dest, keys, how='inner', by_index=False, suffix='_r', output_format=None, mode='create', chunksize=None):
+    """Join two tables sorted by keys and save joined rows.
+
+    left, right, dest - file:/table_name, inputs in any format supported by tabio.
+    keys              - list of key columns.
+    how               - 'inner' or 'left'.
+    by_index          - read tables in order of their completely sorted index on keys[0].
+    suffix            - suffix of right columns whose names clash with left columns.
+    output_format     - output format (see tabio.py).
+    chunksize         - chunksize in bytes.
+    """
+    file_l, node_l = left.split(':')
+    file_r, node_r = right.split(':')
+    file_out, node_out = dest.split(':')
+    tab_l = open_table(file_l, node_l, cache=None)
+    tab_r = open_table(file_r, node_r, cache=None)
+    if chunksize is None:
+        chunksize = default_buffer_size_bytes
+    chunks_l = sorted_chunks(tab_l, keys, max(1, chunksize//tab_l.rowsize), by_index)
+    chunks_r = sorted_chunks(tab_r, keys, max(1, chunksize//tab_r.rowsize), by_index)
+    dtype, _ = joined_dtype(tab_l.dtype, tab_r.dtype, keys, suffix)
+    tab_out  = create_table(file_out, node_out, output_format, mode=mode, row_dtype=dtype, expectedrows=tab_l.nrows)
+    t = 0
+    tic = time()
+    for rows in merge_join(chunks_l, chunks_r, tab_l.dtype, tab_r.dtype, keys, how, suffix):
+        if rows.size > 0:
+            tab_out.append(rows)
+        t += rows.size
+        sys.stdout.write(u'\rSaving joined table {:d} rows ({:.2f} MRows/s)......'.format(t, 1e-6*t/(time()-tic)))
+        sys.stdout.flush()
+    sys.stdout.write(u'\rSaving joined table {:d} rows ({:.2f} MRows/s)......OK\n'.format(t, 1e-6*t/max(1e-9, time()-tic)))
+    sys.stdout.flush()
+    tab_out.close()
+    print(u'Joined table saved to {}:{}.'.format(file_out, node_out))
+
+if __name__ == '__main__':
+    opts, args = gnu_getopt(sys.argv[1:], 'hk:t:is:f:m:b:')
+    how = 'inner'
+    by_index = False
+    suffix = '_r'
+    output_format = None
+    mode = 'create'
+    chunksize = None
+    for opt, val in opts:
+        if opt == '-h':
+            print(__doc__)
+            sys.exit()
+        elif opt == '-k':
+            keys = val.split(',')
+        elif opt == '-t':
+            how = val.lower()
+        elif opt == '-i':
+            by_index = True
+        elif opt == '-s':
+            suffix = val
+        elif opt == '-f':
+            output_format = val
+        elif opt == '-m':
+            mode = val
+        elif opt == '-b':
+            if val.lower().endswith('k'):
+                chunksize = int(int(val[:-1]) * 1024)
+            elif val.lower().endswith('m'):
+                chunksize = int(int(val[:-1]) * 1024**2)
+            elif val.lower().endswith('g'):
+                chunksize = int(int(val[:-1]) * 1024**3)
+            else:
+                chunksize = int(val)
+    join_tables(args[0], args[1], args[2], keys, how=how, by_index=by_index, suffix=suffix, output_format=output_format, mode=mode, chunksize=chunksize)
@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 #coding=utf-8
-"""Select and save HDF5 table to specified container.
+"""Select and save HDF5 table to specified containers.
 
 Syntax:
-  h5select.py [options] source_file:/table_name dest_file:/table_name
+  h5select.py [options] source_file:/table_name dest_file:/table_name [dest_file:/table_name ...]
+
+The source table is read once, each chunk is routed to all destinations.
+The i-th -e and -f options apply to the i-th destination, or to all
+destinations if they are given once.
 
 Options:
   -h  print this message.
-  -e  selection expression.
+  -e  selection expression. Comparisons of enum (categorical) columns with labels,
+      e.g., 'label == "muon"', are evaluated on their integer codes.
   -f  fields.
+  -k  partition key, rows of each destination are split into tables by:
+        hash:COLUMN:N            hash of COLUMN modulo N.
+        value:COLUMN             value (label of enum columns) of COLUMN.
+        range:COLUMN:B1,B2,...   ranges of COLUMN between sorted bounds B1, B2, ...
+      Destinations containing {} are formatted with the partition label,
+      otherwise the label is appended to the table name, e.g., /t_3.
   -c  compression level (0 - 9).
   -l  compression library (default: zlib).
   -p  enable profiling and save result.
   -b  chunksize in bytes, suffix as 'k', 'm' and 'g' are supported.
 
 """
+import re
+import zlib
 import tables
 import sys
 import numpy as np
@@ -23,78 +36,224 @@ from time import time
 from os import path
 from getopt import gnu_getopt
 from multiprocessing import cpu_count
+from tabio import pytables_description, enum_categories, translate_selection, evaluate, default_buffer_size_bytes
+
+appender_size_bytes = 4*1024**2
+
+def parse_partition(spec):
+    """Parse partition key spec into (kind, column, arguments).
+    """
+    parts = spec.split(':')
+    kind = parts[0].lower()
+    if kind == 'hash' and len(parts) == 3:
+        return kind, parts[1], int(parts[2])
+    if kind == 'value' and len(parts) == 2:
+        return kind, parts[1], None
+    if kind == 'range' and len(parts) == 3:
+        bounds = np.array([float(b) for b in parts[2].split(',')])
+        if np.any(np.diff(bounds) <= 0):
+            raise ValueError(u'range bounds {} are not increasing.'.format(parts[2]))
+        return kind, parts[1], bounds
+    raise ValueError(u'unsupported partition key {}.'.format(spec))
+
+def hash_buckets(x, n):
+    """Bucket number of each value of x, deterministic across chunks and runs.
+    """
+    if x.dtype.kind in 'SU':
+        # strings are hashed once per distinct value.
+        uniq, inverse = np.unique(x, return_inverse=True)
+        h = np.array([zlib.crc32(np.asarray(u).tobytes()) for u in uniq], dtype='uint64')[inverse.ravel()]
+    elif x.dtype.kind == 'f':
+        h = (x.astype('float64') + 0.0).view('uint64')  # -0.0 -> 0.0
+    else:
+        h = x.astype('int64').view('uint64')
+    # splitmix64 finalizer, so that every bit of the value, e.g., the high
+    # bits of floats with trailing zero bits, reaches the low bits.
+    with np.errstate(over='ignore'):
+        h = h ^ (h >> np.uint64(30))
+        h = h * np.uint64(0xBF58476D1CE4E5B9)
+        h = h ^ (h >> np.uint64(27))
+        h = h * np.uint64(0x94D049BB133111EB)
+        h = h ^ (h >> np.uint64(31))
+    return (h % np.uint64(n)).astype('int64')
+
+def partition_keys(rows, partition):
+    """Partition key of each row.
+    """
+    kind, cname, args = partition
+    x = rows[cname]
+    if kind == 'hash':
+        return hash_buckets(x, args)
+    if kind == 'range':
+        return np.searchsorted(args, x, side='right')
+    return x
+
+def partition_groups(keys):
+    """Iterate over (key, indices of rows with key), grouping rows by a stable sort.
+    """
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    ends = np.cumsum(np.bincount(inverse, minlength=uniq.size))
+    for key, a, b in zip(uniq, ends-np.bincount(inverse, minlength=uniq.size), ends):
+        yield key, order[a:b]
+
+def partition_label(key, partition, categories):
+    """Label of partition key used in destination names.
+    """
+    kind, cname, _ = partition
+    if kind == 'value' and cname in categories:
+        key = categories[cname][int(key)]
+    if isinstance(key, bytes):
+        key = key.decode('utf-8', 'replace')
+    return re.sub(r'[^\w.+-]+', '_', str(key))
+
+def partition_dest(dest, label):
+    if '{}' in dest:
+        return dest.format(label)
+    return u'{}_{}'.format(dest, label)
+
+class buffered_appender(object):
+    def __init__(self, tab, nrows):
+        """Append rows to PyTables table tab through a buffer of nrows rows.
+
+        Only the fields of tab are copied from the rows appended.
+        """
+        self.tab   = tab
+        self.buf   = np.empty(max(1, nrows), dtype=tab.dtype)
+        self.n     = 0
+        self.nrows = 0
+    def append(self, rows):
+        while rows.size > 0:
+            k = min(rows.size, self.buf.size-self.n)
+            for name in self.buf.dtype.names:
+                self.buf[name][self.n:self.n+k] = rows[name][:k]
+            self.n += k
+            rows = rows[k:]
+            if self.n == self.buf.size:
+                self.flush()
+    def flush(self):
+        if self.n > 0:
+            self.tab.append(self.buf[:self.n])
+            self.nrows += self.n
+            self.n = 0
+
+def select_table(source, dest, selection=None, fields=None, complevel=0, complib='zlib', chunksize=None, profiling=None, outputs=None, partition=None):
+    """Select rows of source table and save them to destination tables in one pass.
+
+    outputs   - list of (selection, fields, dest), [(selection, fields, dest)] by default.
+    partition - partition key (see parse_partition), rows of each output are
+                split into tables named after their partition labels.
 
-def select_table(source, dest, selection, fields=None, complevel=0, complib='zlib', chunksize=None, profiling=None):
+    Each destination table is appended through its own buffer.
+    """
+    if outputs is None:
+        outputs = [(selection, fields, dest)]
+    if isinstance(partition, str):
+        partition = parse_partition(partition)
     file_in, node_in = source.split(':')
-    file_out, node_out = dest.split(':')
     h5_in = tables.open_file(file_in, 'r', max_blosc_threads=(1+2*cpu_count()))
     tab_in = h5_in.get_node(node_in)
-    if fields is None:
-        tab_out_dtype = tab_in.dtype
-    else:
-        a = np.empty((1,), dtype=tab_in.dtype)
-        tab_out_dtype = repack_fields(a[fields]).dtype
-    if profiling is not None:
-        iops = open(profiling, 'w')
-        iops.write(u'bytes,rows,timestamp\n')
-    with tables.open_file(file_out, 'a', max_blosc_threads=(1+2*cpu_count())) as h5_out:
-        if complevel == 0:
-            filters = None
-        else:
-            filters = tables.Filters(complevel=complevel, complib=complib)
-        if chunksize is None:
-            chunkshape = None
+    categories = {}
+    for cname in tab_in.colnames:
+        if tab_in.coltypes[cname] == 'enum':
+            cats = enum_categories(tab_in.get_enum(cname))
+            if cats is not None:
+                categories[cname] = cats
+    if partition is not None and partition[1] not in tab_in.colnames:
+        raise ValueError(u'partition column {} is not in {}.'.format(partition[1], source))
+    routes = []
+    for sel, flds, dst in outputs:
+        if flds is None:
+            dtype = tab_in.dtype
         else:
-            chunkshape = (max(1, chunksize//tab_in.rowsize), )
+            dtype = repack_fields(np.empty((1,), dtype=tab_in.dtype)[flds]).dtype
+        if sel is not None:
+            sel = translate_selection(sel, categories)
+        routes.append((sel, dtype, dst, {}))
+    if complevel == 0:
+        filters = None
+    else:
+        filters = tables.Filters(complevel=complevel, complib=complib)
+    if chunksize is None:
+        chunkshape = None
+    else:
+        chunkshape = (max(1, chunksize//tab_in.rowsize), )
+    h5_out = {}
+    saved  = []
+    def open_output(dst, dtype):
+        file_out, node_out = dst.split(':')
+        if file_out not in h5_out:
+            h5_out[file_out] = tables.open_file(file_out, 'a', max_blosc_threads=(1+2*cpu_count()))
         grpname, tabname = path.split(node_out)
-        tab_out = h5_out.create_table(
+        tab_out = h5_out[file_out].create_table(
             grpname,
             tabname,
-            tab_out_dtype,
+            pytables_description(dtype, categories),
             title         = tab_in.title,
             filters       = filters,
             expectedrows  = tab_in.nrows,
             createparents = True,
             chunkshape    = chunkshape
         )
-        nb = max(tab_in.chunkshape[0], tab_out.chunkshape[0])
+        appender = buffered_appender(tab_out, max(tab_out.chunkshape[0], appender_size_bytes//tab_out.rowsize))
+        saved.append((dst, appender))
+        return appender
+    if profiling is not None:
+        iops = open(profiling, 'w')
+        iops.write(u'bytes,rows,timestamp\n')
+    try:
+        if partition is None:
+            for sel, dtype, dst, appenders in routes:
+                appenders[None] = open_output(dst, dtype)
+        nb = max(tab_in.chunkshape[0], default_buffer_size_bytes//tab_in.rowsize)
         t = 0
         tic = time()
         while t<tab_in.nrows:
             n = min(tab_in.nrows-t, nb)
-            if selection is None:
-                a = tab_in.read(start=t, stop=t+n)
-            else:
-                a = tab_in.read_where(selection, start=t, stop=t+n)
-            if fields is None:
-                tab_out.append(a)
-            else:
-                tab_out.append(repack_fields(a[fields]))
+            a = tab_in.read(start=t, stop=t+n)
+            for sel, dtype, dst, appenders in routes:
+                rows = a if sel is None else a[np.broadcast_to(evaluate(a, sel), (a.size,))]
+                if partition is None:
+                    appenders[None].append(rows)
+                    continue
+                for key, idx in partition_groups(partition_keys(rows, partition)):
+                    if key not in appenders:
+                        appenders[key] = open_output(partition_dest(dst, partition_label(key, partition, categories)), dtype)
+                    appenders[key].append(rows[idx])
             t += n
-            sys.stdout.write(u'\rSaving selected table {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s, {:.2f} GiB/s)......'.format(t, tab_in.nrows, 100.0*t/tab_in.nrows, 1e-6*t/(time()-tic), 1e-9*t*tab_in.rowsize/(time()-tic)))
+            sys.stdout.write(u'\rSaving selected tables {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s, {:.2f} GiB/s)......'.format(t, tab_in.nrows, 100.0*t/tab_in.nrows, 1e-6*t/(time()-tic), 1e-9*t*tab_in.rowsize/(time()-tic)))
             sys.stdout.flush()
             if profiling is not None:
                 iops.write(u'{:d},{:d},{:f}\n'.format(int(n*tab_in.rowsize), int(n), time()-tic))
-        sys.stdout.write(u'\rSaving selected table {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s, {:.2f} GiB/s)......OK\n'.format(t, tab_in.nrows, 100.0*t/tab_in.nrows, 1e-6*t/(time()-tic), 1e-9*t*tab_in.rowsize/(time()-tic)))
+        for _, appender in saved:
+            appender.flush()
+        sys.stdout.write(u'\rSaving selected tables {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s, {:.2f} GiB/s)......OK\n'.format(t, tab_in.nrows, 100.0*t/max(1, tab_in.nrows), 1e-6*t/max(1e-9, time()-tic), 1e-9*t*tab_in.rowsize/max(1e-9, time()-tic)))
         sys.stdout.flush()
+    finally:
         if profiling is not None:
             iops.close()
-    print(u'Selected table saved to {}:{}.'.format(file_out, node_out))
+        for h5 in h5_out.values():
+            h5.close()
+        h5_in.close()
+    for dst, appender in saved:
+        print(u'Selected table saved to {} ({:d} rows).'.format(dst, appender.nrows))
 
 if __name__ == '__main__':
-    opts, args = gnu_getopt(sys.argv[1:], 'he:c:l:b:p:f:')
-    complevel = 0
-    complib = 'zlib'
-    chunksize = None
-    selection = None
-    profiling = None
-    fields    = None
+    opts, args = gnu_getopt(sys.argv[1:], 'he:c:l:b:p:f:k:')
+    complevel  = 0
+    complib    = 'zlib'
+    chunksize  = None
+    selections = []
+    profiling  = None
+    fields     = []
+    partition  = None
     for opt, val in opts:
         if opt == '-h':
             print(__doc__)
             sys.exit()
         elif opt == '-e':
-            selection = val
+            selections.append(val)
         elif opt == '-c':
             complevel = int(val)
         elif opt == '-l':
@@ -102,7 +261,9 @@ if __name__ == '__main__':
         elif opt == '-p':
             profiling = val
         elif opt == '-f':
-            fields = val.split(',')
+            fields.append(val.split(','))
+        elif opt == '-k':
+            partition = parse_partition(val)
         elif opt == '-b':
             if val.lower().endswith('k'):
                 chunksize = int(int(val[:-1]) * 1024)
@@ -113,5 +274,14 @@ if __name__ == '__main__':
             else:
                 chunksize = int(val)
     source = args[0]
-    dest   = args[1]
-    select_table(source, dest, selection, fields=fields, complevel=complevel, complib=complib, chunksize=chunksize, profiling=profiling)
+    dests  = args[1:]
+    for opt, vals in [('-e', selections), ('-f', fields)]:
+        if len(vals) > 1 and len(vals) != len(dests):
+            print(u'{:d} {} options given for {:d} destinations.'.format(len(vals), opt, len(dests)))
+            sys.exit(1)
+    outputs = []
+    for i, dest in enumerate(dests):
+        selection = selections[i if len(selections) > 1 else 0] if selections else None
+        flds = fields[i if len(fields) > 1 else 0] if fields else None
+        outputs.append((selection, flds, dest))
+    select_table(source, None, complevel=complevel, complib=complib, chunksize=chunksize, profiling=profiling, outputs=outputs, partition=partition)
@@ -5,6 +5,10 @@
 Syntax:
   h5sort.py [options] source_file:/table_name dest_file:/table_name
 
+Tables of PyTables files are sorted by their CSI. Tables of other HDF5 files,
+i.e., groups of column datasets written by tabio, are sorted by their tabio
+sorted index (see h5index.py) and saved as such tables.
+
 Options:
   -h  print this message.
   -s  sortby.
@@ -14,6 +18,7 @@ Options:
   -l  compression library (default: zlib).
   -p  enable profiling and save result to a csv file.
   -b  chunksize in bytes, suffix as 'k', 'm' and 'g' are supported.
+  -n  number of processes building tabio sorted indexes (default: number of cores).
 
 """
 import tables
@@ -22,10 +27,61 @@ from os import path
 from getopt import gnu_getopt
 from multiprocessing import cpu_count
 from time import time
+from tabio import hdf5_table, create_table, create_sorted_index, default_buffer_size_bytes
+
+def sort_columns(source, dest, sortby, index=True, descorder=False, complevel=0, chunksize=None, profiling=None, nprocs=None):
+    """Sort table of HDF5 column datasets by its tabio sorted index.
+    """
+    file_in, node_in = source.split(':')
+    file_out, node_out = dest.split(':')
+    tab_in = hdf5_table(fname=file_in, tname=node_in, mode='r')
+    if not tab_in.is_indexed(sortby):
+        print(u'{} is not indexed.'.format(sortby))
+        if not index:
+            print(u'Goodbye.')
+            sys.exit()
+        tab_in.close()
+        sys.stdout.write(u'Creating sorted index for {}......'.format(sortby))
+        sys.stdout.flush()
+        create_sorted_index(file_in, node_in, sortby, nprocs=nprocs)
+        sys.stdout.write(u'\rCreating sorted index for {}......OK\n'.format(sortby))
+        sys.stdout.flush()
+        tab_in = hdf5_table(fname=file_in, tname=node_in, mode='r')
+    if profiling is not None:
+        iops = open(profiling, 'w')
+        iops.write(u'bytes,rows,timestamp\n')
+    tab_out = create_table(file_out, node_out, 'hdf5', mode='a', row_dtype=tab_in.dtype,
+        compression='gzip' if complevel > 0 else None, categories=tab_in.categories)
+    if chunksize is None:
+        chunksize = default_buffer_size_bytes
+    nb = max(1, chunksize//tab_in.rowsize)
+    t = 0
+    tic = time()
+    while t<tab_in.nrows:
+        n = min(tab_in.nrows-t, nb)
+        if descorder:
+            a = tab_in.read_sorted(sortby, start=tab_in.nrows-1-t, stop=tab_in.nrows-1-t-n if t+n<tab_in.nrows else None, step=-1)
+        else:
+            a = tab_in.read_sorted(sortby, start=t, stop=t+n)
+        tab_out.append(a)
+        t += n
+        sys.stdout.write(u'\rSaving sorted table {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s, {:.2f} GiB/s)......'.format(t, tab_in.nrows, 100.0*t/tab_in.nrows, 1e-6*t/(time()-tic), 1e-9*tab_in.rowsize*t/(time()-tic)))
+        sys.stdout.flush()
+        if profiling is not None:
+            iops.write(u'{:d},{:d},{:f}\n'.format(int(t*tab_in.rowsize), int(t), time()-tic))
+    sys.stdout.write(u'\rSaving sorted table {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s, {:.2f} GiB/s)......OK\n'.format(t, tab_in.nrows, 100.0*t/max(1, tab_in.nrows), 1e-6*t/max(1e-9, time()-tic), 1e-9*tab_in.rowsize*t/max(1e-9, time()-tic)))
+    sys.stdout.flush()
+    if profiling is not None:
+        iops.close()
+    tab_in.close()
+    tab_out.close()
+    print(u'Sorted table saved to {}:{}.'.format(file_out, node_out))
 
-def sort_table(source, dest, sortby, index=True, descorder=False, complevel=0, complib='zlib', chunksize=None, profiling=None):
+def sort_table(source, dest, sortby, index=True, descorder=False, complevel=0, complib='zlib', chunksize=None, profiling=None, nprocs=None):
     file_in, node_in = source.split(':')
     file_out, node_out = dest.split(':')
+    if not tables.is_pytables_file(file_in):
+        return sort_columns(source, dest, sortby, index=index, descorder=descorder, complevel=complevel, chunksize=chunksize, profiling=profiling, nprocs=nprocs)
     h5_in = tables.open_file(file_in, 'r')
     tab_in = h5_in.get_node(node_in)
     if not tab_in.cols.__getattribute__(sortby).is_indexed:
@@ -90,13 +146,14 @@ def sort_table(source, dest, sortby, index=True, descorder=False, complevel=0, c
     print(u'Sorted table saved to {}:{}.'.format(file_out, node_out))
 
 if __name__ == '__main__':
-    opts, args = gnu_getopt(sys.argv[1:], 'hs:irc:l:b:p:')
+    opts, args = gnu_getopt(sys.argv[1:], 'hs:irc:l:b:p:n:')
     index  = False
     complevel = 0
     complib = 'zlib'
     chunksize = None
     profiling = None
     descorder = False
+    nprocs = None
     for opt, val in opts:
         if opt == '-h':
             print(__doc__)
@@ -113,6 +170,8 @@ if __name__ == '__main__':
             complib = val
         elif opt == '-p':
             profiling = val
+        elif opt == '-n':
+            nprocs = int(val)
         elif opt == '-b':
             if val.lower().endswith('k'):
                 chunksize = int(int(val[:-1]) * 1024)
@@ -124,4 +183,4 @@ if __name__ == '__main__':
                 chunksize = int(val)
     source = args[0]
     dest   = args[1]
-    sort_table(source, dest, sortby, index=index, complevel=complevel, complib=complib, chunksize=chunksize, profiling=profiling)
+    sort_table(source, dest, sortby, index=index, descorder=descorder, complevel=complevel, complib=complib, chunksize=chunksize, profiling=profiling, nprocs=nprocs)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""Select top-k rows, or estimate quantiles of columns, in one read-only pass.
+
+Syntax:
+  h5topk.py [options] source_file:/table_name [dest_file:/table_name]
+
+Source table can be in any format supported by tabio.
+
+Top-k mode (-k) saves the k rows with the highest values of the sort column to
+dest_file:/table_name in descending order, without sorting the table. Each
+process keeps the k best rows of its chunks, found with np.argpartition, and
+the partial results are merged the same way.
+
+Quantile mode (-q) prints approximate quantiles of columns, estimated with
+mergeable quantile sketches (see quantile_sketch) built in parallel.
+
+Options:
+  -h  print this message.
+  -k  number of rows to select (top-k mode).
+  -s  sort column or expression of columns of top-k mode, e.g., px**2+py**2.
+  -r  select the k rows with the lowest values instead.
+  -q  quantiles, comma separated, e.g., 0.01,0.5,0.99 (quantile mode).
+  -c  columns of quantile mode, comma separated (default: all numeric columns).
+  -a  accuracy of quantile sketches, i.e., their number of items per level (default: 1024).
+  -e  selection expression.
+  -f  output format (see tabio.py, default: HDF5).
+  -m  output mode (see tabio.py, default: create).
+  -n  number of processes (default: number of cores).
+  -b  chunksize in bytes, suffix as 'k', 'm' and 'g' are supported.
+
+"""
+import sys
+import numpy as np
+from getopt import gnu_getopt
+from tabio import open_table, create_table, evaluate, select_rows, parallel_scan
+
+default_sketch_size = 1024
+
+def sort_keys(rows, sortby, reverse=False):
+    """Values of sort column or expression, negated so that the best rows have the highest keys.
+    """
+    if sortby in rows.dtype.names:
+        keys = rows[sortby]
+    else:
+        keys = np.broadcast_to(evaluate(rows, sortby), (rows.size,))
+    keys = keys.astype('float64')
+    if reverse:
+        keys = -keys
+    return keys
+
+def top_rows(rows, keys, k):
+    """Rows with the k highest keys, in no particular order.
+
+    Rows with NaN keys are never selected.
+    """
+    valid = ~np.isnan(keys)
+    if not np.all(valid):
+        rows, keys = rows[valid], keys[valid]
+    if keys.size <= k:
+        return rows, keys
+    idx = np.argpartition(keys, keys.size-k)[keys.size-k:]
+    return rows[idx], keys[idx]
+
+def merge_top(parts, k):
+    """Merge partial top-k results (rows, keys) into the k best rows.
+
+    The concatenated candidates are partitioned again, so that at most k rows
+    are kept between merges, as a bounded heap would but in one vectorized step.
+    """
+    parts = [p for p in parts if p is not None]
+    rows = np.concatenate([p[0] for p in parts])
+    keys = np.concatenate([p[1] for p in parts])
+    return top_rows(rows, keys, k)
+
+class quantile_sketch(object):
+    def __init__(self, size=default_sketch_size):
+        """Mergeable sketch of a stream of values for approximate quantiles.
+
+        size - number of items kept by the top level; the rank error is about
+               1.7/size of the number of values.
+
+        Items of level h stand for 2**h values. A level over its capacity is
+        sorted and every other item, from a random offset, is promoted to the
+        next level. Capacities shrink by 2/3 per level below the top one, as in
+        KLL sketches, so the sketch keeps O(size) items however many values
+        are added. Sketches of disjoint parts of a stream merge by levels.
+        """
+        self.size   = int(size)
+        self.levels = [np.empty(0, dtype='float64')]
+        self.count  = 0
+        self.vmin   = np.inf
+        self.vmax   = -np.inf
+        self.rng    = np.random.default_rng()
+
+    def capacity(self, h):
+        return max(2, int(np.ceil(self.size*(2.0/3.0)**(len(self.levels)-1-h))))
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64').ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+        self.count += values.size
+        self.vmin   = min(self.vmin, values.min())
+        self.vmax   = max(self.vmax, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        return self
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype='float64'))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.count += other.count
+        self.vmin   = min(self.vmin, other.vmin)
+        self.vmax   = max(self.vmax, other.vmax)
+        self.compress()
+        return self
+
+    def compress(self):
+        """Compact levels over their capacity, lowest first, until none is.
+        """
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if items.size <= self.capacity(h):
+                h += 1
+                continue
+            if h+1 == len(self.levels):
+                self.levels.append(np.empty(0, dtype='float64'))
+            items = np.sort(items)
+            # an odd item out stays at this level.
+            keep  = items[:items.size % 2]
+            items = items[items.size % 2:]
+            self.levels[h+1] = np.concatenate([self.levels[h+1], items[self.rng.integers(2)::2]])
+            self.levels[h]   = keep
+            # capacities of lower levels shrink when a level is added.
+            h = 0
+
+    def quantiles(self, qs):
+        """Approximate values at quantiles qs, NaN if the sketch is empty.
+        """
+        qs = np.asarray(qs, dtype='float64')
+        if self.count == 0:
+            return np.full(qs.shape, np.nan)
+        items   = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.size, 2.0**h) for h, level in enumerate(self.levels)])
+        order   = np.argsort(items, kind='stable')
+        items   = items[order]
+        ranks   = np.cumsum(weights[order])
+        i = np.searchsorted(ranks, qs*ranks[-1], side='left')
+        values = items[np.minimum(i, items.size-1)]
+        values[qs <= 0] = self.vmin
+        values[qs >= 1] = self.vmax
+        return values
+
+def scan_chunks(tab, chunks, params):
+    """Top-k rows or quantile sketches of chunks of rows (see tabio.parallel_scan).
+    """
+    selection, mode, args = params
+    if mode == 'topk':
+        sortby, k, reverse = args
+        result = None
+        for _, rows in chunks:
+            rows = select_rows(rows, selection, tab.categories)
+            part = top_rows(rows, sort_keys(rows, sortby, reverse), k)
+            result = part if result is None else merge_top([result, part], k)
+    else:
+        columns, size = args
+        result = dict((c, quantile_sketch(size)) for c in columns)
+        for _, rows in chunks:
+            rows = select_rows(rows, selection, tab.categories)
+            for c in columns:
+                result[c].update(rows[c])
+    return result
+
+def scan_table(source, mode, params, selection=None, nprocs=None, chunksize=None):
+    """Scan table in parallel, yielding partial results of scan_chunks as they complete.
+    """
+    file_in, node_in = source.split(':')
+    return parallel_scan(file_in, node_in, scan_chunks, (selection, mode, params), nprocs=nprocs, chunksize=chunksize)
+
+def top_k(source, sortby, k, reverse=False, selection=None, nprocs=None, chunksize=None):
+    """Rows of source with the k highest (lowest if reverse) values of sortby, best first.
+
+    sortby - column, or expression of columns (see tabio.evaluate).
+    """
+    result = None
+    for part in scan_table(source, 'topk', (sortby, int(k), reverse), selection, nprocs, chunksize):
+        if part is not None:
+            result = part if result is None else merge_top([result, part], k)
+    if result is None:
+        file_in, node_in = source.split(':')
+        tab_in = open_table(file_in, node_in, cache=None)
+        return np.empty(0, dtype=tab_in.dtype)
+    rows, keys = result
+    return rows[np.argsort(-keys, kind='stable')]
+
+def column_quantiles(source, qs, columns=None, size=default_sketch_size, selection=None, nprocs=None, chunksize=None):
+    """Approximate quantiles qs of columns of source.
+
+    Returns dict of column to (values at qs, number of values).
+    """
+    if columns is None:
+        file_in, node_in = source.split(':')
+        tab_in = open_table(file_in, node_in, cache=None)
+        columns = [c for c in tab_in.dtype.names if tab_in.dtype[c].kind in 'biuf' and c not in tab_in.categories]
+        tab_in.close()
+    sketches = dict((c, quantile_sketch(size)) for c in columns)
+    for part in scan_table(source, 'quantile', (columns, size), selection, nprocs, chunksize):
+        for c in columns:
+            sketches[c].merge(part[c])
+    return dict((c, (sketches[c].quantiles(qs), sketches[c].count)) for c in columns)
+
+def print_quantiles(qs, result):
+    print(u' | '.join([u'{:>15}'.format('column'), u'{:>12}'.format('count')]+[u'{:>12}'.format('q={:g}'.format(q)) for q in qs]))
+    print(u'{:-^80}'.format(''))
+    for c, (values, count) in result.items():
+        print(u' | '.join([u'{:>15}'.format(c), u'{:>12d}'.format(count)]+[u'{:>12.6g}'.format(v) for v in values]))
+
+if __name__ == '__main__':
+    opts, args = gnu_getopt(sys.argv[1:], 'hk:s:rq:c:a:e:f:m:n:b:')
+    k         = None
+    sortby    = None
+    reverse   = False
+    qs        = None
+    columns   = None
+    size      = default_sketch_size
+    selection = None
+    output_format = None
+    mode      = 'create'
+    nprocs    = None
+    chunksize = None
+    for opt, val in opts:
+        if opt == '-h':
+            print(__doc__)
+            sys.exit()
+        elif opt == '-k':
+            k = int(val)
+        elif opt == '-s':
+            sortby = val
+        elif opt == '-r':
+            reverse = True
+        elif opt == '-q':
+            qs = [float(q) for q in val.split(',')]
+        elif opt == '-c':
+            columns = val.split(',')
+        elif opt == '-a':
+            size = int(val)
+        elif opt == '-e':
+            selection = val
+        elif opt == '-f':
+            output_format = val
+        elif opt == '-m':
+            mode = val
+        elif opt == '-n':
+            nprocs = int(val)
+        elif opt == '-b':
+            if val.lower().endswith('k'):
+                chunksize = int(int(val[:-1]) * 1024)
+            elif val.lower().endswith('m'):
+                chunksize = int(int(val[:-1]) * 1024**2)
+            elif val.lower().endswith('g'):
+                chunksize = int(int(val[:-1]) * 1024**3)
+            else:
+                chunksize = int(val)
+    source = args[0]
+    if k is not None:
+        rows = top_k(source, sortby, k, reverse=reverse, selection=selection, nprocs=nprocs, chunksize=chunksize)
+        file_in, node_in = source.split(':')
+        file_out, node_out = args[1].split(':')
+        categories = open_table(file_in, node_in, cache=None).categories
+        tab_out = create_table(file_out, node_out, output_format, mode=mode, row_dtype=rows.dtype, expectedrows=rows.size, categories=categories)
+        tab_out.append(rows)
+        tab_out.close()
+        print(u'Top {:d} rows by {} saved to {}:{}.'.format(rows.size, sortby, file_out, node_out))
+    elif qs is not None:
+        print_quantiles(qs, column_quantiles(source, qs, columns=columns, size=size, selection=selection, nprocs=nprocs, chunksize=chunksize))
+    else:
+        print(__doc__)
@@ -8,6 +8,18 @@ Options:
                     ROOT[Tree, TTree]: Table implemented with ROOT TFile contains TTree object.
                     HDF5: Table implemented with HDF5 datasets contained in the same group.
                     TABLES[TABLE, PyTables]: Native PyTables format.
+                    PARQUET[PQ]: Apache Parquet file, one row group per read batch.
+                    ARROW[Feather, IPC]: Apache Arrow IPC file (Feather V2).
+                    NPY: Directory of one .npy file per column, which np.load(mmap_mode='r')
+                    maps directly.
+                    These formats are also supported as input.
+
+--compression[-c]=CODEC Compression of HDF5, PyTables, Parquet and Arrow output.
+                    Parquet codecs may be set per column as COLUMN:CODEC,...
+
+--categorical[-k]=COLUMN,... Save string columns as categorical columns: codes of
+                    their sorted unique labels, plus the labels. Selections compare
+                    codes of categorical columns, e.g., 'label == "muon"'.
 
 --start=START       From START row to STOP row, by STEP of rows.
 --stop=STOP
@@ -20,22 +32,107 @@ Options:
                     'Create'['w', 'new']
                     'Update'['a', 'append']
 
+--parallel[-p]=MODE Parallel read mode of ROOT input. Supported modes:
+                    'IMT'['thread', 'threads']: ROOT implicit multi-threading.
+                    'Process'['processes', 'mp']: pool of processes reading disjoint
+                    entry clusters through shared memory.
+
+--nprocs[-n]=NPROCS Number of threads or processes used in parallel read mode.
+
+--selection[-e]=EXPR Copy only rows satisfying selection expression, e.g., '(E>10) & (n<5)'.
+
+--incremental[-i]   In 'Update' mode, copy source rows added since the last run.
+
+Conversions record a checkpoint in the output table: source identity, the last
+committed source row and the start/stop/step, sample and selection parameters.
+Rerunning an interrupted conversion in 'Update' mode continues from that row.
+
+input_file may also be a glob pattern or a directory of files that hold tables of
+the same schema, read as one table (see catalog.py).
+
+--profile-import    Print import time and RSS of tabio and of each backend loaded.
+
+Format backends (ROOT, h5py, PyTables, pyarrow) are imported only when a file of their
+format, detected by magic bytes or extension, is opened.
 """
+from time import time
+import_tic = time()
+# RSS is measured before numpy and the other imports of tabio.
+def rss_bytes():
+    """Resident set size of this process.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*page_size
+    except IOError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+try:
+    from os import sysconf
+    page_size = sysconf('SC_PAGE_SIZE')
+except (ImportError, ValueError):
+    page_size = 4096
+import_rss = rss_bytes()
 import sys
-import h5py
-import tables
+import re
+import json
+import struct
 import numpy as np
 from six import iteritems
-from multiprocessing import cpu_count
-from ROOT import TFile,TTree,TDirectoryFile
-from os import path
+from multiprocessing import cpu_count, Pool
+from multiprocessing import shared_memory
+from importlib import import_module
+from os import path, listdir, makedirs, remove, replace
 from array import array
-from time import time
-from root_numpy import array2tree,tree2array
+from shutil import rmtree
+from tempfile import mkdtemp
+from chunkcache import default_cache,default_chunk_size_bytes,file_key,read_chunks,take_chunks,discard_chunks
+
+import_stats = {}
+class lazy_module(object):
+    def __init__(self,name,setup=None):
+        """Module imported on first access to its attributes.
+
+        name  - name of module.
+        setup - function called with the module once it is imported.
 
-tables.set_blosc_max_threads(cpu_count())
+        Import time and RSS growth of each module are recorded in import_stats.
+        """
+        self.__dict__['name']   = name
+        self.__dict__['setup']  = setup
+        self.__dict__['module'] = None
+    def load(self):
+        if self.module is None:
+            tic = time()
+            rss = rss_bytes()
+            module = import_module(self.name)
+            if self.setup is not None:
+                self.setup(module)
+            self.__dict__['module'] = module
+            import_stats[self.name] = (time()-tic, rss_bytes()-rss)
+        return self.module
+    def __getattr__(self,attr):
+        return getattr(self.load(),attr)
+
+h5py       = lazy_module('h5py')
+pyarrow    = lazy_module('pyarrow')
+parquet    = lazy_module('pyarrow.parquet')
+arrow_ipc  = lazy_module('pyarrow.ipc')
+tables     = lazy_module('tables', setup=lambda m: m.set_blosc_max_threads(cpu_count()))
+numexpr    = lazy_module('numexpr')
+ROOT       = lazy_module('ROOT')
+root_numpy = lazy_module('root_numpy')
+
+def print_import_stats():
+    for name,(seconds,rss) in sorted(import_stats.items(), key=lambda x: x[1][0]):
+        print(u'{:<12} imported in {:.3f} seconds, RSS +{:.1f} MiB.'.format(name, seconds, rss/1024.0**2))
 
 default_buffer_size_bytes = 32*1024**2
+default_block_size_bytes = 256*1024
+default_scratch_size_bytes = 4*1024**2
+default_nprocs = cpu_count()
+checkpoint_name = 'tabio_checkpoint'
+categories_name = 'tabio_categories'
 numpy_type_to_root_type = {
     'string' :'C',
     'int8'   :'B',
@@ -51,6 +148,7 @@ numpy_type_to_root_type = {
     'bool'   :'O'
     }
 numpy_type_to_python_type = {
+    'string' :'b',
     'int8'   :'b',
     'uint8'  :'B',
     'int16'  :'h',
@@ -91,6 +189,14 @@ numpy_type_to_root_type = {
     'uint64' :'l',
     'bool'   :'O'
     }
+def numpy_type_name(dtype):
+    """Name of dtype in the type maps, 'string' for fixed-width byte strings.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'S':
+        return 'string'
+    return dtype.name
+
 root_type_name_to_python_type={
     'Bool_t'   :'b',
     'Char_t'   :'b',
@@ -136,9 +242,18 @@ pytables_file_mode={
     'write'   :'w',
     'create'  :'w',
     'w'       :'w',
+    'r'       :'r',
     'read'    :'r',
     'readonly':'r'
     }
+root_parallel_mode={
+    'imt'      :'imt',
+    'thread'   :'imt',
+    'threads'  :'imt',
+    'process'  :'process',
+    'processes':'process',
+    'mp'       :'process'
+    }
 hdf5_file_mode={
     'update'  :'a',
     'a'       :'a',
@@ -163,91 +278,486 @@ def create_groups(h5file, group):
                 parent_obj = h5file.create_group(parent_obj, g)
     return parent_obj
 
-def convert_table(input_fname,input_tname,output_fname=None,mode='create',output_format=None,output_tname=None,start=None,stop=None,step=None,samplerate=1.0):
-    """Convert input table from input format to specified output format.
+categories_group = '_categories'
+offsets_suffix   = '.offsets'
+index_group      = '_index'
+default_fence_step = 1024
+index_sample_size  = 1024**2
+
+hdf5_signature = b'\x89HDF\r\n\x1a\n'
+root_signature = b'root'
+parquet_signature = b'PAR1'
+arrow_signature   = b'ARROW1'
+def detect_format(fname):
+    """Format of file, detected by magic bytes, or by extension if they are unrecognized.
+
+    HDF5 files written by PyTables are told apart by the attributes of their root group.
     """
+    if path.isdir(fname):
+        if any(f.endswith('.npy') for f in listdir(fname)):
+            return 'npy'
+        return None
+    with open(fname,'rb') as f:
+        head = f.read(8)
+        if head[:4] == parquet_signature:
+            return 'parquet'
+        if head[:6] == arrow_signature:
+            return 'arrow'
 
-    #
-    # parse input
-    _,extname = path.splitext(input_fname)
-    if extname.lower() == '.root':
-        tabin = tree_table(fname=input_fname,tname=input_tname,mode='readonly')
-    elif tables.is_hdf5_file(input_fname):
-        if tables.is_pytables_file(input_fname):
-            ifile = tables.open_file(input_fname,'r')
-            tabin = ifile.get_node(path.join('/',input_tname))
-        else:
-            tabin = hdf5_table(fname=input_fname,tname=input_tname,mode='r')
-    else:
-        raise TypeError('Unrecognized file format: %s.'%input_fname)
+        # HDF5 superblock is at offset 0, 512, 1024, 2048, ... after a user block.
+        offset = 512
+        while head != hdf5_signature and head[:4] != root_signature:
+            f.seek(offset)
+            head = f.read(8)
+            if len(head) < 8:
+                break
+            offset *= 2
+    if head[:4] == root_signature:
+        return 'root'
+    if head == hdf5_signature:
+        with h5py.File(fname,'r') as f:
+            if 'PYTABLES_FORMAT_VERSION' in f.attrs:
+                return 'pytables'
+        return 'hdf5'
+    _,extname = path.splitext(fname)
+    return format_extensions.get(extname.lower())
 
-    nrows_in = tabin.nrows
-    dtype    = tabin.dtype
-    print('Input table contains %d rows.'%nrows_in)
+format_extensions = {
+    '.root'   :'root',
+    '.h5'     :'hdf5',
+    '.hdf5'   :'hdf5',
+    '.parquet':'parquet',
+    '.pq'     :'parquet',
+    '.arrow'  :'arrow',
+    '.feather':'arrow',
+    '.ipc'    :'arrow'
+    }
+backends = {}
+def register_backend(fmt,opener):
+    """Register function that opens tables of format for reading.
 
-    if not start:
-        start = 0
-    if not stop:
-        stop  = nrows_in
-    if not step:
-        step  = 1
-    nrows_out = int(np.ceil(1.0*(stop-start)/step))
+    opener(fname, tname, **options) returns the table. It should import the
+    libraries of the format on call, e.g., through lazy_module, so that they
+    are loaded only when a file of the format is opened.
+    """
+    backends[fmt] = opener
 
-    #
-    # parse output
-    if output_fname:
-        _,extname = path.splitext(output_fname)
-        if extname.lower() == '.root':
-            output_format = 'root'
-    if output_format:
-        if not output_fname:
-            if output_format.lower() in ['h5','hdf5','table','tables','pytables']:
-                output_fname = path.splitext(input_fname)[0] + '.h5'
-            if output_format.lower() in ['root','tree','ttree']:
-                output_fname = path.splitext(input_fname)[0] + '.root'
-    if not output_tname:
-        output_tname = input_tname
+register_backend('root',     lambda fname,tname,**options: tree_table(fname=fname,tname=tname,mode='readonly',**options))
+register_backend('hdf5',     lambda fname,tname,cache=default_cache,**options: hdf5_table(fname=fname,tname=tname,mode='r',cache=cache))
+register_backend('pytables', lambda fname,tname,cache=default_cache,**options: pytables_table(fname=fname,tname=tname,mode='r',cache=cache))
+
+register_backend('parquet',  lambda fname,tname,cache=default_cache,**options: parquet_table(fname=fname,mode='r',cache=cache))
+register_backend('arrow',    lambda fname,tname,cache=default_cache,**options: arrow_table(fname=fname,mode='r',cache=cache))
+register_backend('npy',      lambda fname,tname,**options: npy_table(fname=fname,mode='r'))
+register_backend('catalog',  lambda fname,tname,cache=default_cache,**options: import_module('catalog').dataset_catalog(fname,tname,cache=cache))
 
+def is_catalog(fname):
+    """fname is a glob pattern, or a directory that is not a table of its own, of a catalog of files.
+    """
+    if any(c in fname for c in '*?['):
+        return True
+    return path.isdir(fname) and detect_format(fname) is None
 
+def open_table(fname,tname,cache=default_cache,parallel=None,nprocs=None):
+    """Open table in any supported format for reading.
+
+    fname may also be a glob pattern or a directory of files, read as one table
+    through a dataset catalog (see catalog.py).
+    parallel and nprocs select the parallel read mode of ROOT input (see tree_table).
+    """
+    if is_catalog(fname):
+        fmt = 'catalog'
+    else:
+        fmt = detect_format(fname)
+    if fmt not in backends:
+        raise TypeError('Unrecognized file format: %s.'%fname)
+    return backends[fmt](fname,tname,cache=cache,parallel=parallel,nprocs=nprocs)
+
+def create_table(fname,tname,output_format=None,mode='create',row_dtype=None,nrows_max=None,expectedrows=None,compression=None,categories=None,jagged=None):
+    """Create table in output format for writing.
+
+    output_format - output format (see convert_table), guessed from the extension of fname by default.
+    nrows_max     - capacity of HDF5 tables, which grow on append if it is None.
+    expectedrows  - expected number of rows of PyTables tables.
+    compression   - compression of HDF5, PyTables, Parquet and Arrow tables, or
+                    dict of codecs per column of Parquet tables.
+    categories    - labels of categorical columns, which row_dtype gives as codes.
+    jagged        - dtypes of values of jagged columns of HDF5, Parquet and Arrow tables.
+    """
+    if not output_format:
+        _,extname = path.splitext(fname)
+        output_format = format_extensions.get(extname.lower(), 'hdf5')
+    if jagged and output_format.lower() not in ['h5','hdf5','parquet','pq','arrow','feather','ipc']:
+        raise TypeError('Jagged columns are not supported by output format %s.'%output_format)
     if output_format.lower() in ['h5','hdf5']:
-        tabout = hdf5_table(fname=output_fname,tname=output_tname,mode=hdf5_file_mode[mode],row_dtype=dtype,nrows_max=nrows_out)
+        return hdf5_table(fname=fname,tname=tname,mode=hdf5_file_mode[mode],row_dtype=row_dtype,nrows_max=nrows_max,
+            compression=compression or 'lzf',categories=categories,jagged=jagged)
     elif output_format.lower() in ['root','tree','ttree']:
-        tabout = tree_table(fname=output_fname,tname=output_tname,mode=root_file_mode[mode],row_dtype=dtype)
+        return tree_table(fname=fname,tname=tname,mode=root_file_mode[mode],row_dtype=row_dtype,categories=categories)
     elif output_format.lower() in ['table','tables','pytables']:
-        ofile  = tables.open_file(output_fname,pytables_file_mode[mode])
-        tdir,tname = path.split(output_tname)
-        parent_obj = create_groups(ofile, tdir)
-        tabout = ofile.create_table(parent_obj,tname,
-            description=tables.descr_from_dtype(dtype)[0],
-            expectedrows=int(nrows_out*samplerate/step),
-            filters=tables.Filters(complevel=5,complib='blosc'))
+        filters = None
+        if compression:
+            filters = tables.Filters(complevel=5,complib=compression)
+        return pytables_table(fname=fname,tname=tname,mode=pytables_file_mode[mode],row_dtype=row_dtype,
+            expectedrows=expectedrows or nrows_max,filters=filters,categories=categories)
+    elif output_format.lower() in ['parquet','pq']:
+        return parquet_table(fname=fname,mode=mode,row_dtype=row_dtype,compression=compression,categories=categories,jagged=jagged)
+    elif output_format.lower() in ['arrow','feather','ipc']:
+        return arrow_table(fname=fname,mode=mode,row_dtype=row_dtype,compression=compression,categories=categories,jagged=jagged)
+    elif output_format.lower() in ['npy']:
+        return npy_table(fname=fname,mode=mode,row_dtype=row_dtype,categories=categories)
     else:
         raise TypeError('Unsupported output format %s.'%output_format)
 
+def evaluate(rows,expr):
+    """Evaluate expression over fields of rows.
+
+    Expressions follow the syntax of PyTables conditions, e.g., '(E>10) & (n<5)'.
+    """
+    return numexpr.evaluate(expr, local_dict=dict((key, rows[key]) for key in rows.dtype.names))
+
+def selection_mask(rows,selection,categories=None):
+    """Mask of rows satisfying selection expression.
+
+    Comparisons of categorical columns with labels are evaluated on their codes
+    (see translate_selection).
+    """
+    if categories:
+        selection = translate_selection(selection,categories)
+    return np.broadcast_to(evaluate(rows,selection),(rows.size,))
+
+def select_rows(rows,selection,categories=None):
+    """Rows satisfying selection expression, all rows if selection is None.
+    """
+    if selection is None:
+        return rows
+    return rows[selection_mask(rows,selection,categories)]
+
+def string_dtype(values):
+    """Fixed-width byte string dtype of the longest value.
+    """
+    return np.dtype('S%d'%max(1, max([len(v) for v in values] or [1])))
+
+def categories_to_json(categories):
+    return dict((cname, [c.decode('utf-8') for c in cats]) for cname,cats in iteritems(categories))
+
+def categories_from_json(obj):
+    categories = {}
+    for cname,labels in iteritems(obj):
+        labels = [c.encode('utf-8') for c in labels]
+        categories[cname] = np.array(labels, dtype=string_dtype(labels))
+    return categories
+
+def code_dtype(ncategories):
+    """Smallest unsigned integer dtype of codes of ncategories categories.
+    """
+    for ctype in ['uint8','uint16','uint32']:
+        if ncategories <= np.iinfo(ctype).max+1:
+            return np.dtype(ctype)
+    return np.dtype('uint64')
+
+def scan_categories(tab,cnames,start=None,stop=None,step=None):
+    """Sorted unique labels of string columns cnames of table.
+
+    Columns are read one at a time in buffers of default_buffer_size_bytes.
+    """
+    start,stop,step = slice(start,stop,step).indices(tab.nrows)
+    categories = {}
+    for cname in cnames:
+        if tab.dtype[cname].kind not in 'SU':
+            raise TypeError('Column %s is not a string column.'%cname)
+        nbuf = max(1, default_buffer_size_bytes//tab.dtype[cname].itemsize)*step
+        labels = np.empty(0, dtype=tab.dtype[cname])
+        for t in range(start,stop,nbuf):
+            labels = np.union1d(labels, tab.read_column(cname,t,min(stop,t+nbuf),step))
+        if labels.dtype.kind == 'U':
+            labels = np.char.encode(labels,'utf-8')
+        categories[cname] = labels.astype(string_dtype(labels))
+    return categories
+
+def categorical_dtype(dtype,categories):
+    """Row dtype with string columns of categories replaced by their codes.
+    """
+    return np.dtype([(cname, code_dtype(len(categories[cname])) if cname in categories and dtype[cname].kind in 'SU' else np.dtype(dtype[cname].str))
+        for cname in dtype.names])
+
+def encode_categories(rows,categories,dtype,out=None,recode=None):
+    """Rows of dtype with labels of categorical columns replaced by their codes.
+
+    Columns of rows that are codes already are copied, or translated through
+    recode, which maps columns to the new code of each of their codes.
+    """
+    recode = recode or {}
+    out = output_buffer(out,rows.size,dtype)
+    for cname in dtype.names:
+        if cname in categories and rows.dtype[cname].kind in 'SU':
+            labels = rows[cname]
+            if labels.dtype.kind == 'U':
+                labels = np.char.encode(labels,'utf-8')
+            cats  = categories[cname]
+            codes = np.minimum(np.searchsorted(cats, labels), max(0, cats.size-1))
+            if cats.size == 0 or np.any(cats[codes] != labels):
+                raise ValueError('Column %s has labels out of its categories.'%cname)
+            out[cname] = codes
+        elif cname in recode:
+            out[cname] = recode[cname][rows[cname]]
+        else:
+            out[cname] = rows[cname]
+    return out
+
+def stored_categories(fname,tname):
+    """Labels of categorical columns and checkpoint of existing table tname in fname.
+
+    Returns ({}, None) if there is no such table.
+    """
+    try:
+        tab = open_table(fname,tname,cache=None)
+    except (KeyError,ValueError,IOError,OSError):
+        return {},None
+    categories = tab.categories
+    checkpoint = tab.get_checkpoint()
+    tab.close()
+    return categories,checkpoint
+
+def reconcile_categories(categories,stored,source):
+    """Replace labels of categories by labels stored in an existing output table.
+
+    Rows appended to a table must be encoded with the labels already stored
+    in it, so labels missing from them are rejected. Returns the categories
+    and the recode maps of columns that are categorical in source.
+    """
+    categories = dict(categories)
+    recode = {}
+    for cname,cats in iteritems(categories):
+        if cname not in stored or np.array_equal(cats,stored[cname]):
+            continue
+        missing = np.setdiff1d(cats,stored[cname])
+        if missing.size > 0:
+            raise ValueError('Labels %s of column %s are not among the labels stored in the output table.'%(
+                ', '.join(c.decode('utf-8') for c in missing),cname))
+        if cname in source:
+            recode[cname] = np.searchsorted(stored[cname],cats)
+        categories[cname] = stored[cname]
+    return categories,recode
+
+def decode_categories(rows,categories):
+    """Rows with codes of categorical columns replaced by their labels.
+    """
+    dtype = np.dtype([(cname, categories[cname].dtype if cname in categories else rows.dtype[cname])
+        for cname in rows.dtype.names])
+    out = np.empty(rows.size, dtype=dtype)
+    for cname in dtype.names:
+        if cname in categories:
+            out[cname] = categories[cname][rows[cname]]
+        else:
+            out[cname] = rows[cname]
+    return out
+
+label_comparison = re.compile(r"""\b(\w+)\s*(==|!=|<=|>=|<|>)\s*b?(?:'([^']*)'|"([^"]*)")""")
+reversed_comparison = re.compile(r"""b?(?:'([^']*)'|"([^"]*)")\s*(==|!=|<=|>=|<|>)\s*(\w+)\b""")
+reversed_operator = {'==':'==', '!=':'!=', '<':'>', '>':'<', '<=':'>=', '>=':'<='}
+def translate_selection(selection,categories):
+    """Translate comparisons of categorical columns with labels into comparisons of codes.
+
+    Categories are sorted, so that order comparisons translate as well, e.g.,
+    with categories [b'a', b'c'], "label >= 'b'" becomes "label >= 1".
+    Labels out of the categories compare equal to no code.
+    """
+    def code(cname,op,label):
+        cats  = categories[cname]
+        label = label.encode('utf-8')
+        if op in ['==','!=']:
+            i = int(np.searchsorted(cats,label))
+            if i >= cats.size or cats[i] != label:
+                i = cats.size
+            return '(%s %s %d)'%(cname,op,i)
+        if cats.size > 1 and not np.all(cats[:-1] < cats[1:]):
+            raise ValueError('Categories of %s are not sorted.'%cname)
+        if op in ['<','>=']:
+            return '(%s %s %d)'%(cname,op,int(np.searchsorted(cats,label,side='left')))
+        return '(%s %s %d)'%(cname,{'<=':'<','>':'>='}[op],int(np.searchsorted(cats,label,side='right')))
+    def forward(m):
+        cname,op = m.group(1),m.group(2)
+        if cname not in categories:
+            return m.group(0)
+        return code(cname,op,m.group(3) if m.group(3) is not None else m.group(4))
+    def backward(m):
+        op,cname = m.group(3),m.group(4)
+        if cname not in categories:
+            return m.group(0)
+        return code(cname,reversed_operator[op],m.group(1) if m.group(1) is not None else m.group(2))
+    return reversed_comparison.sub(backward, label_comparison.sub(forward, selection))
+
+def source_identity(fname,tname,tab):
+    """Identity of source table in checkpoints.
+
+    Files are identified by path, table name and row dtype, so that a source
+    file that grows between runs is still recognized.
+    """
+    return {'fname':path.realpath(fname), 'tname':tname, 'dtype':str(tab.dtype.descr)}
+
+def convert_table(input_fname,input_tname,output_fname=None,mode='create',output_format=None,output_tname=None,start=None,stop=None,step=None,samplerate=1.0,parallel=None,nprocs=None,selection=None,incremental=False,compression=None,categorical=None):
+    """Convert input table from input format to specified output format.
+
+    compression is the codec of output table (see create_table).
+    categorical is a list of string columns saved as categorical columns, i.e.,
+    codes of their sorted unique labels. Categorical input columns stay categorical.
+    Jagged input columns are copied as flat values and offsets, the rows
+    sampled and selected are picked from them in vectorized steps.
+
+    parallel and nprocs select the parallel read mode of ROOT input (see tree_table).
+    selection is an expression of columns of rows to be copied (see evaluate).
+
+    Rows are read into buffers reused from batch to batch (see buffer_pool),
+    so that the conversion loop does not allocate arrays of rows per batch.
+
+    A checkpoint is saved in the output table after each buffer is committed.
+    In update mode, a conversion whose checkpoint matches the source and the
+    parameters continues from the last committed row. If incremental is True
+    and stop is not specified, it also copies source rows added since then.
+    """
+
     #
-    # transfer data
-    t    = start
-    tic  = time()
-    nbuf = default_buffer_size_bytes / tabin.rowsize
-    while t < stop:
-        n    = int(min(nbuf, int(stop - t)))
-        rows = tabin.read(t,t+n,step)
-        if samplerate<1.0:
-            accepted    = np.bool_(np.random.rand(rows.size)<samplerate)
-            nsamples    = np.sum(accepted)
-            rows_sample = np.empty(nsamples, dtype=rows.dtype)
-            for field in rows.dtype.fields:
-                rows_sample[field][:] = rows[field][accepted]
-            rows = rows_sample
-        tabout.append(rows)
-        t   += n
-        sys.stdout.write('\r%d (%.2f%%) rows processed. %.2f seconds elapsed.'%(t-start,100.0*(t-start)/(stop-start),time()-tic))
-        sys.stdout.flush()
-
-    if output_format.lower() in ['root','tree','ttree']:
-        #tabout.tree.Fill()
-        tabout.file.Write()
-        tabout.file.Close()
+    # parse input
+    # input is read once from start to stop, so it bypasses the chunk cache.
+    tabin = open_table(input_fname,input_tname,cache=None,parallel=parallel,nprocs=nprocs)
+    tabout = None
+    # both tables are closed however the conversion ends, so that it can be resumed.
+    try:
+
+        nrows_in = tabin.nrows
+        dtype    = tabin.dtype
+        print('Input table contains %d rows.'%nrows_in)
+
+        stop_given = bool(stop)
+        if not start:
+            start = 0
+        if not stop:
+            stop  = nrows_in
+        if not step:
+            step  = 1
+        nrows_out = int(np.ceil(1.0*(stop-start)/step))
+
+        #
+        # parse output
+        if output_fname:
+            _,extname = path.splitext(output_fname)
+            if format_extensions.get(extname.lower()) in ['root','parquet','arrow']:
+                output_format = format_extensions[extname.lower()]
+        if output_format:
+            if not output_fname:
+                if output_format.lower() in ['h5','hdf5','table','tables','pytables']:
+                    output_fname = path.splitext(input_fname)[0] + '.h5'
+                if output_format.lower() in ['root','tree','ttree']:
+                    output_fname = path.splitext(input_fname)[0] + '.root'
+                if output_format.lower() in ['parquet','pq']:
+                    output_fname = path.splitext(input_fname)[0] + '.parquet'
+                if output_format.lower() in ['arrow','feather','ipc']:
+                    output_fname = path.splitext(input_fname)[0] + '.arrow'
+                if output_format.lower() in ['npy']:
+                    output_fname = path.splitext(input_fname)[0] + '_npy'
+        if not output_tname:
+            output_tname = input_tname
+
+
+        identity = {
+            'source'    :source_identity(input_fname,input_tname,tabin),
+            'start'     :int(start),
+            'step'      :int(step),
+            'samplerate':float(samplerate),
+            'selection' :selection
+            }
+        stored,last = {},None
+        if mode.lower() in ['update','a','append'] and path.exists(output_fname):
+            stored,last = stored_categories(output_fname,output_tname)
+        categories = dict(tabin.categories)
+        if categorical:
+            scan = [c for c in categorical if c not in categories]
+            resumed = [c for c in scan if c in stored]
+            if resumed and last is not None and all(last.get(k) == identity[k] for k in identity):
+                # rows committed are encoded with the stored labels already,
+                # only rows after them are scanned for labels.
+                scan_stop = stop if (incremental or stop_given) else last['stop']
+                categories.update(scan_categories(tabin,resumed,last['committed'],max(last['committed'],scan_stop),step))
+                scan = [c for c in scan if c not in stored]
+            if scan:
+                categories.update(scan_categories(tabin,scan,start,stop,step))
+        recode = {}
+        if stored:
+            # codes of rows appended refer to the labels stored in the output table.
+            categories,recode = reconcile_categories(categories,stored,tabin.categories)
+        dtype_out = categorical_dtype(dtype,categories)
+
+        jagged = tabin.jagged
+
+        tabout = create_table(output_fname,output_tname,output_format,mode=mode,row_dtype=dtype_out,
+            expectedrows=int(nrows_out*samplerate/step),compression=compression,categories=categories,jagged=jagged)
+
+        #
+        # resume from checkpoint
+        checkpoint = dict(identity)
+        checkpoint.update({
+            'stop'      :int(stop),
+            'committed' :int(start),
+            'nrows'     :int(tabout.nrows)
+            })
+        t = start
+        last = tabout.get_checkpoint()
+        if last is not None and mode.lower() in ['update','a','append']:
+            if all(last.get(k) == checkpoint[k] for k in ['source','start','step','samplerate','selection']):
+                t = last['committed']
+                if not (incremental or stop_given):
+                    stop = last['stop']
+                checkpoint['stop'] = int(max(stop, last['stop']))
+                tabout.truncate(last['nrows'])
+                print('Resume from row %d (%d rows committed).'%(t,last['nrows']))
+            else:
+                print('Checkpoint of output table does not match this conversion, start from row %d.'%start)
+
+        #
+        # transfer data
+        t0   = t
+        tic  = time()
+        rowsize = tabin.rowsize
+        for key in jagged:
+            # bytes of values per row, estimated from the first rows.
+            head = tabin.read_jagged(key,0,min(nrows_in,1024))
+            rowsize += head.values.nbytes/max(1,head.size)
+        nbuf = default_buffer_size_bytes / max(1,rowsize)
+        if isinstance(tabin, tree_table) and tabin.parallel == 'process':
+            # one buffer per worker process.
+            nbuf *= tabin.nprocs
+        # buffers hold whole steps, so that each one starts at a selected row.
+        nbuf = max(step, int(nbuf)//step*step)
+        buffers = buffer_pool()
+        while t < stop:
+            n    = int(min(nbuf, int(stop - t)))
+            rows = tabin.read(t,t+n,step,out=buffers.get('rows',len(range(t,t+n,step)),dtype))
+            cols = dict((key, tabin.read_jagged(key,t,t+n,step)) for key in jagged)
+            if samplerate<1.0:
+                accepted = np.random.rand(rows.size)<samplerate
+                rows = np.compress(accepted, rows, out=buffers.get('sample',int(np.count_nonzero(accepted)),dtype))
+                cols = dict((key, col.compress(accepted)) for key,col in iteritems(cols))
+            if selection is not None:
+                accepted = selection_mask(rows,selection,tabin.categories)
+                rows = np.compress(accepted, rows, out=buffers.get('selected',int(np.count_nonzero(accepted)),dtype))
+                cols = dict((key, col.compress(accepted)) for key,col in iteritems(cols))
+            if categories:
+                rows = encode_categories(rows,categories,dtype_out,out=buffers.get('encoded',rows.size,dtype_out),recode=recode)
+            if jagged:
+                tabout.append(rows,cols)
+            else:
+                tabout.append(rows)
+            t   += n
+            checkpoint['committed'] = int(t)
+            checkpoint['nrows']     = int(tabout.nrows)
+            tabout.set_checkpoint(checkpoint)
+            sys.stdout.write('\r%d (%.2f%%) rows processed. %.2f seconds elapsed.'%(t-t0,100.0*(t-t0)/(stop-t0),time()-tic))
+            sys.stdout.flush()
+    finally:
+        if tabout is not None:
+            tabout.close()
+        tabin.close()
     print("\nOutput: %s:%s"%(output_fname,output_tname))
 
 
@@ -255,7 +765,7 @@ class branch_array(object):
     def __init__(self,branch=None,tree=None,fname=None,tname=None,bname=None):
         if not branch:
             if not tree:
-                tfile    = TFile(fname,'readonly')
+                tfile    = ROOT.TFile(fname,'readonly')
                 tree     = tfile.Get(tname)
             branch   = tree.GetBranch(bname)
         tree  = branch.GetTree()
@@ -264,28 +774,38 @@ class branch_array(object):
         self.branch  = branch
         tdirectory   = tree.GetDirectory()
         self.file    = tdirectory.GetFile()
-        self.type    = branch.GetLeaf(bname).GetTypeName()
-        self.dtype   = np.dtype(root_type_name_to_numpy_type[self.type])
+        self.leaf    = branch.GetLeaf(bname)
+        self.type    = self.leaf.GetTypeName()
+        # char string leaves are read as fixed-width strings of their longest value.
+        self.string  = self.leaf.IsA().GetName() == 'TLeafC'
+        if self.string:
+            self.dtype = np.dtype('S%d'%max(1, self.leaf.GetMaximum()))
+        else:
+            self.dtype = np.dtype(root_type_name_to_numpy_type[self.type])
         self.size    = branch.GetEntries()
         self.shape   = (self.size,)
-        self.__ptr__ = array(root_type_name_to_python_type[self.type],[0])
+        self.__ptr__ = array(root_type_name_to_python_type[self.type],[0]*(self.dtype.itemsize+1 if self.string else 1))
         self.branch.SetAddress(self.__ptr__)
     def __len__(self):
         return self.branch.GetEntries()
+    def value(self):
+        if self.string:
+            return self.__ptr__.tobytes().split(b'\0',1)[0]
+        return self.__ptr__[0]
     def __getitem__(self,i):
         self.branch.SetAddress(self.__ptr__)
         if isinstance(i,int):
             if self.branch.GetEntry(i):
-                return self.__ptr__[0]
+                return self.value()
             else:
                 raise IndexError("Index %d out of range."%i)
         elif isinstance(i,slice):
             start,stop,step = i.indices(self.branch.GetEntries())
             n = int(np.ceil((stop - start)/step))
-            a = np.empty(n,dtype=root_type_name_to_numpy_type[self.type])
+            a = np.empty(n,dtype=self.dtype)
             for k in range(n):
                 self.branch.GetEntry(start+k*step)
-                a[k] = self.__ptr__[0]
+                a[k] = self.value()
             return a
 
 class sparse_array(object):
@@ -314,7 +834,156 @@ class sparse_array(object):
     def __len__(self):
         return int(np.ceil(1.0*(self.stop-self.start)/self.step))
 
+class jagged_array(object):
+    def __init__(self,values,offsets):
+        """Variable-length rows stored as flat values and offsets.
+
+        Row i is values[offsets[i]:offsets[i+1]], so that offsets has one more
+        entry than rows. All operations work on the flat buffers without
+        building per-row objects.
+        """
+        self.values  = np.asarray(values)
+        self.offsets = np.asarray(offsets,dtype='int64')
+        self.dtype   = self.values.dtype
+        self.size    = self.offsets.size-1
+    def __len__(self):
+        return self.size
+    def counts(self):
+        return np.diff(self.offsets)
+    def __getitem__(self,i):
+        if isinstance(i,(int,np.integer)):
+            i = range(self.size)[i]
+            return self.values[self.offsets[i]:self.offsets[i+1]]
+        if isinstance(i,slice):
+            start,stop,step = i.indices(self.size)
+            if step == 1:
+                return jagged_array(self.values,self.offsets[start:max(start,stop)+1])
+            return self.take(np.arange(start,stop,step))
+        i = np.asarray(i)
+        if i.dtype == bool:
+            return self.compress(i)
+        return self.take(i)
+    def take(self,indices):
+        """Rows at indices, gathered in one vectorized step.
+        """
+        indices = np.asarray(indices,dtype='int64')
+        lo  = self.offsets[indices]
+        cnt = self.offsets[indices+1]-lo
+        offsets = np.zeros(indices.size+1,dtype='int64')
+        np.cumsum(cnt,out=offsets[1:])
+        return jagged_array(self.values[jagged_elements(lo,cnt,offsets)],offsets)
+    def compress(self,mask):
+        return self.take(np.flatnonzero(mask))
+    def compact(self):
+        """Copy whose values hold only its rows and whose offsets start at 0.
+        """
+        return jagged_array(self.values[self.offsets[0]:self.offsets[-1]],self.offsets-self.offsets[0])
+    def to_objects(self):
+        """Object array of one array per row, e.g., for ROOT variable-length branches.
+        """
+        arr = np.empty(self.size,dtype=object)
+        arr[:] = np.split(self.values[self.offsets[0]:self.offsets[-1]], self.offsets[1:-1]-self.offsets[0])
+        return arr
+
+def jagged_elements(lo,cnt,offsets=None):
+    """Flat positions of elements of rows starting at lo with cnt elements each.
+    """
+    if offsets is None:
+        offsets = np.zeros(cnt.size+1,dtype='int64')
+        np.cumsum(cnt,out=offsets[1:])
+    return np.repeat(lo-offsets[:-1],cnt)+np.arange(offsets[-1],dtype='int64')
+
+def concatenate_jagged(arrays,dtype=None):
+    """Rows of jagged arrays one after another.
+    """
+    arrays = [a.compact() for a in arrays]
+    if len(arrays) == 0:
+        return jagged_array(np.empty(0,dtype=dtype),np.zeros(1,dtype='int64'))
+    if len(arrays) == 1:
+        return arrays[0]
+    ends = np.cumsum([0]+[a.values.size for a in arrays[:-1]])
+    offsets = np.concatenate([arrays[0].offsets[:1]]+[a.offsets[1:]+e for a,e in zip(arrays,ends)])
+    return jagged_array(np.concatenate([a.values for a in arrays]),offsets)
+
+def jagged_from_objects(objs,dtype):
+    """Jagged array of object array of one array per row, as root_numpy reads variable-length branches.
+    """
+    offsets = np.zeros(len(objs)+1,dtype='int64')
+    np.cumsum([len(o) for o in objs],out=offsets[1:])
+    if offsets[-1] == 0:
+        return jagged_array(np.empty(0,dtype=dtype),offsets)
+    return jagged_array(np.concatenate(list(objs)).astype(dtype,copy=False),offsets)
+
+def output_buffer(out,n,dtype):
+    """First n rows of buffer out, or a new array of n rows if out is None.
+    """
+    if out is None:
+        return np.empty(n,dtype=dtype)
+    if out.dtype != dtype or out.size < n:
+        raise ValueError('Output buffer of %d rows of %s cannot hold %d rows of %s.'%(out.size,out.dtype,n,dtype))
+    return out[:n]
+
+def columns_to_records(cols,out,block=default_block_size_bytes):
+    """Copy columns into fields of records out, block by block.
+
+    Rows of a block stay in cache while each of their fields is written,
+    instead of all rows being streamed through once per field.
+    """
+    nb = max(1, block//max(1,out.dtype.itemsize))
+    for t in range(0,out.size,nb):
+        rows = out[t:t+nb]
+        for key,col in iteritems(cols):
+            rows[key] = col[t:t+nb]
+    return out
+
+def records_to_columns(rows,cols,block=default_block_size_bytes):
+    """Copy fields of records rows into contiguous columns, block by block.
+    """
+    nb = max(1, block//max(1,rows.dtype.itemsize))
+    for t in range(0,rows.size,nb):
+        blk = rows[t:t+nb]
+        for key,col in iteritems(cols):
+            col[t:t+nb] = blk[key]
+    return cols
+
+class buffer_pool(object):
+    def __init__(self):
+        """Named arrays reused across batches, grown only when a batch needs more rows.
+        """
+        self.buffers = {}
+    def get(self,name,n,dtype):
+        """First n rows of buffer name of dtype.
+        """
+        dtype = np.dtype(dtype)
+        buf = self.buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < n:
+            buf = np.empty(max(1,n),dtype=dtype)
+            self.buffers[name] = buf
+        return buf[:n]
+    def columns(self,name,n,dtype):
+        """Contiguous buffers of n rows of each field of dtype.
+        """
+        return dict((key, self.get((name,key),n,dtype[key])) for key in dtype.names)
+    def clear(self):
+        self.buffers.clear()
+
 class table(object):
+    """Table of columns of equal size.
+
+    Columns are read through the process-wide chunk cache (see chunkcache) if
+    the table has a cache and chunklen(key) is not None. Set cache to None to
+    bypass it, e.g., for a single sequential scan.
+
+    categories maps each categorical column to its sorted labels, which the
+    column stores as codes, i.e., indices into the labels.
+
+    jagged maps each jagged (variable-length) column to the dtype of its
+    values. Jagged columns are not fields of rows, they are read separately
+    as jagged_array with read_jagged and take_jagged.
+    """
+    cache = None
+    categories = {}
+    jagged = {}
     def __init__(self,columns):
         self.cols    = {}
         self.dtype   = []
@@ -322,7 +991,7 @@ class table(object):
         self.nrows   = np.inf
         for key,val in iteritems(columns):
             self.cols[key] = val
-            self.dtype.append((key.encode('ascii'),np.dtype(val.dtype)))
+            self.dtype.append((key,np.dtype(val.dtype)))
             self.rowsize += np.dtype(val.dtype).itemsize
             self.nrows = int(min(self.nrows, val.size))
         self.dtype = np.dtype(self.dtype)
@@ -333,23 +1002,176 @@ class table(object):
         for key,val in iteritems(self.cols):
             cols[key] = val
         for key,val in iteritems(tab.cols):
-            if not cols.has_key(key):
+            if key not in cols:
                 cols[key] = val
         return table(cols)
-    def read(self,start=None,stop=None,step=None):
-        start = max(start,0)
-        step  = max(step, 1)
-        if not stop:
-            stop = self.nrows
-        n = int(np.ceil(1.0*(stop-start)/step))
-        arr = np.empty(n,dtype=self.dtype)
-        for key,val in iteritems(self.cols):
-            arr[key] = val[start:stop:step]
+    def chunklen(self,key):
+        """Number of rows per chunk of column key, None if it is not chunked.
+        """
+        return None
+    def chunk_key(self,key):
+        """(file, dataset) identity of column key in the chunk cache.
+        """
+        return (id(self), key)
+    def load(self,key,start,stop,step=1):
+        """Read rows of column key bypassing the chunk cache.
+        """
+        return self.cols[key][start:stop:step]
+    def read_column(self,key,start=None,stop=None,step=None):
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        chunklen = self.chunklen(key)
+        if self.cache is None or chunklen is None or step < 0:
+            return self.load(key,start,stop,step)
+        return read_chunks(self.cache, self.chunk_key(key), chunklen, self.nrows,
+            lambda a,b: self.load(key,a,b), start, stop, step)
+    def read(self,start=None,stop=None,step=None,out=None):
+        """Read rows start:stop:step, into the first rows of buffer out if it is given.
+        """
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        n = len(range(start,stop,step))
+        arr = output_buffer(out,n,self.dtype)
+        for key in self.cols:
+            arr[key] = self.read_column(key,start,stop,step)
         return arr
+    def close(self):
+        pass
+    def get_checkpoint(self):
+        """Checkpoint of the conversion that wrote this table, None if there is none.
+        """
+        return None
+    def set_checkpoint(self,checkpoint):
+        """Save checkpoint in this table. Tables that cannot store checkpoints ignore it.
+        """
+        pass
+    def truncate(self,nrows):
+        """Drop rows after the first nrows rows, e.g., rows not covered by a checkpoint.
+        """
+        if nrows != self.nrows:
+            raise NotImplementedError("Truncation is not supported by %s."%type(self).__name__)
+    def iter_chunks(self,start=None,stop=None,step=None,chunksize=None):
+        """Iterate over rows start:stop:step in chunks.
+
+        chunksize - number of rows per chunk, a buffer of default_buffer_size_bytes by default.
+
+        Yields (t, rows), where t is the row number of the first row of the chunk.
+        """
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        if not chunksize:
+            chunksize = max(1, default_buffer_size_bytes//self.rowsize)
+        for t in range(start,stop,chunksize*step):
+            yield t, self.read(t,min(stop,t+chunksize*step),step)
+    def unique_rows(self,indices):
+        """Sorted unique row numbers of indices and the inverse permutation.
+        """
+        indices = np.asarray(indices, dtype='int64').ravel()
+        indices = np.where(indices<0, indices+self.nrows, indices)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.nrows):
+            raise IndexError("Index out of range.")
+        return np.unique(indices, return_inverse=True)
+    def take_column(self,key,rows):
+        """Read column key at sorted unique rows, decompressing each chunk once.
+        """
+        chunklen = self.chunklen(key)
+        cache    = self.cache
+        if chunklen is None:
+            chunklen = max(1, default_chunk_size_bytes//self.dtype[key].itemsize)
+            cache    = None
+        return take_chunks(cache, self.chunk_key(key), chunklen, self.nrows,
+            lambda a,b: self.load(key,a,b), rows)
+    def take(self,indices):
+        """Read rows at indices, returned in the order of indices.
+
+        Indices are sorted and deduplicated, then grouped by chunk, so that each
+        chunk is read once however many of its rows are requested.
+        """
+        rows,inverse = self.unique_rows(indices)
+        arr = np.empty(inverse.size,dtype=self.dtype)
+        for key in self.cols:
+            arr[key] = self.take_column(key,rows)[inverse]
+        return arr
+    def load_jagged(self,key,start,stop):
+        """Read rows start:stop of jagged column key.
+        """
+        raise NotImplementedError("Jagged columns are not supported by %s."%type(self).__name__)
+    def read_jagged(self,key,start=None,stop=None,step=None):
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        if step != 1:
+            return self.take_jagged(key,np.arange(start,stop,step))
+        return self.load_jagged(key,start,max(start,stop))
+    def jagged_chunks(self,key,rows):
+        """Chunk number of each of rows of jagged column key.
+        """
+        return rows//max(1, default_chunk_size_bytes//self.jagged[key].itemsize)
+    def take_jagged(self,key,indices):
+        """Read rows of jagged column key at indices.
+
+        Indices are grouped by chunk (see jagged_chunks). Rows between the first
+        and the last index of each chunk are read, then gathered.
+        """
+        rows,inverse = self.unique_rows(indices)
+        if rows.size == 0:
+            return jagged_array(np.empty(0,dtype=self.jagged[key]),np.zeros(1,dtype='int64'))
+        ids  = self.jagged_chunks(key,rows)
+        ends = np.append(np.flatnonzero(np.diff(ids))+1, rows.size)
+        parts = []
+        k = 0
+        for j in ends:
+            parts.append(self.load_jagged(key,int(rows[k]),int(rows[j-1])+1).take(rows[k:j]-rows[k]))
+            k = j
+        return concatenate_jagged(parts,self.jagged[key]).take(inverse)
+
+scanned_tables = {}
+def scan_range(args):
+    """Apply function to chunks of rows start:stop of table (process pool worker of parallel_scan).
+
+    Tables stay open in the worker across ranges.
+    """
+    fname,tname,start,stop,chunksize,func,params = args
+    if (fname,tname) not in scanned_tables:
+        scanned_tables[(fname,tname)] = open_table(fname,tname,cache=None)
+    tab = scanned_tables[(fname,tname)]
+    return func(tab,tab.iter_chunks(start,stop,chunksize=chunksize),params), stop-start
+
+def parallel_scan(fname,tname,func,params=None,nprocs=None,chunksize=None,title='Scanning table'):
+    """Scan disjoint row ranges of table in parallel, yielding results as they complete.
+
+    func     - module level function func(tab, chunks, params) of the rows of a
+               range, where chunks iterates over (t, rows) (see iter_chunks).
+    nprocs   - number of processes.
+    chunksize - chunksize in bytes.
+    title    - title of the progress line.
+    """
+    tab    = open_table(fname,tname,cache=None)
+    nrows  = tab.nrows
+    nb     = max(1, (chunksize or default_buffer_size_bytes)//tab.rowsize)
+    tab.close()
+    nprocs = nprocs or default_nprocs
+    # a few ranges per process to balance the load.
+    nr = max(nb, int(np.ceil(1.0*nrows/(4*nprocs)/nb))*nb)
+    jobs = [(fname,tname,t,min(nrows,t+nr),nb,func,params) for t in range(0,nrows,nr)]
+    t = 0
+    tic = time()
+    with Pool(nprocs) as pool:
+        for result,n in pool.imap_unordered(scan_range,jobs):
+            t += n
+            sys.stdout.write(u'\r{} {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s)......'.format(title, t, nrows, 100.0*t/max(1, nrows), 1e-6*t/max(1e-9, time()-tic)))
+            sys.stdout.flush()
+            yield result
+    sys.stdout.write(u'\r{} {:d}/{:d} rows ({:.1f}%, {:.2f} MRows/s)......OK\n'.format(title, t, nrows, 100.0*t/max(1, nrows), 1e-6*t/max(1e-9, time()-tic)))
+    sys.stdout.flush()
 
 class hdf5_table(table):
-    def __init__(self,fname=None,tname=None,mode="r",nrows_max=None,row_dtype=None,chunks=True,compression="lzf"):
+    def __init__(self,fname=None,tname=None,mode="r",nrows_max=None,row_dtype=None,chunks=True,compression="lzf",cache=default_cache,categories=None,jagged=None):
+        """Table implemented with HDF5 datasets contained in the same group.
+
+        categories - labels of categorical columns of new tables, saved in the
+                     categories_group subgroup next to the codes.
+        jagged     - dtypes of values of jagged columns of new tables. A jagged
+                     column is a dataset of flat values and a dataset of int64
+                     offsets named after it with offsets_suffix.
+        """
         mode = hdf5_file_mode[mode]
+        self.cache    = cache
         self.cols     = {}
         self.dtype    = []
         self.rowsize  = 0
@@ -364,15 +1186,15 @@ class hdf5_table(table):
                     self.cols[cname] = self.group.require_dataset(cname,dtype=ctype)
                     self.nrows = int(min(self.nrows, self.cols[cname].size))
                     self.nrows_max = self.nrows
-                    self.dtype.append((cname.encode('ascii'), np.dtype(self.cols[cname].dtype)))
+                    self.dtype.append((cname, np.dtype(self.cols[cname].dtype)))
                     self.rowsize += np.dtype(self.cols[cname].dtype).itemsize
             else:
                 for cname,col in iteritems(self.group):
-                    if len(col.shape) == 1:
+                    if isinstance(col,h5py.Dataset) and len(col.shape) == 1 and not self.is_jagged_member(cname):
                         self.cols[cname] = col
                         self.nrows = int(min(self.nrows, col.size))
                         self.nrows_max = self.nrows
-                        self.dtype.append((cname.encode('ascii'), np.dtype(col.dtype)))
+                        self.dtype.append((cname, np.dtype(col.dtype)))
                         self.rowsize += np.dtype(col.dtype).itemsize
         elif mode.lower() in ['a', 'append', 'update']:
             self.writable = True
@@ -387,78 +1209,966 @@ class hdf5_table(table):
                 except:
                     self.nrows = np.inf
             if row_dtype:
+                self.nrows_max = np.inf
                 for cname,ctype in iteritems(row_dtype.fields):
                     ctype = ctype[0]
-                    self.cols[cname] = self.group.require_dataset(cname,shape=(nrows_max,),dtype=ctype,chunks=chunks,compression=compression)
+                    self.cols[cname] = self.require_column(cname,ctype,nrows_max,chunks,compression)
                     self.nrows = int(min(self.nrows, self.cols[cname].size))
-                    self.nrows_max = int(min(nrows_max, self.cols[cname].size))
-                    self.dtype.append((cname.encode('ascii'), np.dtype(self.cols[cname].dtype)))
+                    self.nrows_max = min(self.nrows_max, self.column_capacity(cname))
+                    self.dtype.append((cname, np.dtype(self.cols[cname].dtype)))
                     self.rowsize += np.dtype(self.cols[cname].dtype).itemsize
             else:
                 self.nrows_max = nrows_max
                 if not self.nrows_max:
                     self.nrows_max = np.inf
                 for cname,col in iteritems(self.group):
-                    if len(col.shape) == 1:
+                    if isinstance(col,h5py.Dataset) and len(col.shape) == 1 and not self.is_jagged_member(cname):
                         self.cols[cname] = col
                         self.nrows = int(min(self.nrows, col.size))
-                        self.nrows_max = int(min(self.nrows_max, col.size))
-                        self.dtype.append((cname.encode('ascii'), np.dtype(col.dtype)))
+                        self.nrows_max = min(self.nrows_max, self.column_capacity(cname))
+                        self.dtype.append((cname, np.dtype(col.dtype)))
                         self.rowsize += np.dtype(col.dtype).itemsize
         elif mode.lower() in ['w', 'write', 'recreate']:
             self.writable = True
             self.nrows     = 0
-            self.nrows_max = int(nrows_max)
+            self.nrows_max = np.inf if nrows_max is None else int(nrows_max)
             self.file = h5py.File(fname,'w')
             self.group = self.file.require_group(tname)
             for cname,ctype in iteritems(row_dtype.fields):
                 ctype = ctype[0]
-                self.cols[cname] = self.group.create_dataset(cname,shape=(self.nrows_max,),dtype=ctype,chunks=chunks,compression=compression)
-                self.dtype.append((cname.encode('ascii'), np.dtype(self.cols[cname].dtype)))
+                self.cols[cname] = self.require_column(cname,ctype,nrows_max,chunks,compression)
+                self.dtype.append((cname, np.dtype(self.cols[cname].dtype)))
                 self.rowsize += np.dtype(self.cols[cname].dtype).itemsize
         else:
             raise StandardError('unrecognized mode %s'%mode)
         self.dtype = np.dtype(self.dtype)
+        self.open_jagged(jagged,chunks,compression)
+        if self.writable and categories:
+            self.write_categories(categories)
+        self.categories = self.read_categories()
 
-    def append(self,rows):
+        self.file_key = file_key(fname)
+        self.buffers  = buffer_pool()
+
+    def require_column(self,cname,ctype,nrows_max,chunks,compression):
+        """Open column cname, create it if it does not exist.
+
+        Columns of tables without nrows_max are created empty and resized by append.
+        """
+        if cname in self.group:
+            return self.group[cname]
+        if nrows_max is None:
+            return self.group.create_dataset(cname,shape=(0,),maxshape=(None,),dtype=ctype,chunks=chunks,compression=compression)
+        return self.group.create_dataset(cname,shape=(int(nrows_max),),dtype=ctype,chunks=chunks,compression=compression)
+
+    def is_jagged_member(self,cname):
+        return cname.endswith(offsets_suffix) or cname+offsets_suffix in self.group
+
+    def open_jagged(self,jagged,chunks,compression):
+        """Open jagged columns of the group, create those of jagged that do not exist.
+        """
+        if self.writable and jagged:
+            for cname,ctype in iteritems(jagged):
+                if cname not in self.group:
+                    self.group.create_dataset(cname,shape=(0,),maxshape=(None,),dtype=ctype,chunks=chunks,compression=compression)
+                    self.group.create_dataset(cname+offsets_suffix,data=np.zeros(1,dtype='int64'),maxshape=(None,),chunks=chunks,compression=compression)
+        self.jagged      = {}
+        self.jagged_cols = {}
+        for cname,col in iteritems(self.group):
+            if isinstance(col,h5py.Dataset) and cname+offsets_suffix in self.group:
+                offsets = self.group[cname+offsets_suffix]
+                self.jagged[cname]      = np.dtype(col.dtype)
+                self.jagged_cols[cname] = (col,offsets)
+                self.nrows = int(min(self.nrows, offsets.size-1))
+
+    def read_dataset(self,ds,start,stop):
+        """Read rows start:stop of dataset through the chunk cache.
+        """
+        if self.cache is None:
+            return ds[start:stop]
+        return read_chunks(self.cache, self.file_key+(ds.name,), self.dataset_chunklen(ds), ds.size,
+            lambda a,b: ds[a:b], start, stop)
+
+    def take_dataset(self,ds,rows):
+        """Read dataset at sorted rows, decompressing each chunk once.
+        """
+        return take_chunks(self.cache, self.file_key+(ds.name,), self.dataset_chunklen(ds), ds.size,
+            lambda a,b: ds[a:b], rows)
+
+    def read(self,start=None,stop=None,step=None,out=None):
+        """Read rows start:stop:step, into the first rows of buffer out if it is given.
+
+        Without chunk cache, contiguous rows of each column are read directly
+        into reused column buffers of default_scratch_size_bytes in total, then
+        transposed into rows (see columns_to_records), one slab of rows at a time.
+        """
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        if self.cache is not None or step != 1:
+            return table.read(self,start,stop,step,out)
+        n = max(0,stop-start)
+        arr = output_buffer(out,n,self.dtype)
+        nslab = max(1, default_scratch_size_bytes//max(1,self.rowsize))
+        for t in range(0,n,nslab):
+            m = min(nslab,n-t)
+            cols = self.buffers.columns('read',m,self.dtype)
+            for key,col in iteritems(cols):
+                self.cols[key].read_direct(col,np.s_[start+t:start+t+m])
+            columns_to_records(cols,arr[t:t+m])
+        return arr
+
+    def load_jagged(self,key,start,stop):
+        values,offsets = self.jagged_cols[key]
+        o = self.read_dataset(offsets,start,stop+1)
+        return jagged_array(self.read_dataset(values,o[0],o[-1]),o-o[0])
+
+    def take_jagged(self,key,indices):
+        """Read rows of jagged column key at indices.
+
+        Offsets of the rows are gathered chunk by chunk, then their values are.
+        """
+        values,offsets = self.jagged_cols[key]
+        rows,inverse = self.unique_rows(indices)
+        lo  = self.take_dataset(offsets,rows)
+        cnt = self.take_dataset(offsets,rows+1)-lo
+        o   = np.zeros(rows.size+1,dtype='int64')
+        np.cumsum(cnt,out=o[1:])
+        return jagged_array(self.take_dataset(values,jagged_elements(lo,cnt,o)),o).take(inverse)
+
+    def sorted_index(self,key):
+        """Permutation and fences of the sorted index of column key (see create_sorted_index).
+        """
+        if index_group not in self.group or key not in self.group[index_group]:
+            raise ValueError('Column %s is not indexed.'%key)
+        grp = self.group[index_group][key]
+        if int(grp.attrs['nrows']) != self.nrows:
+            raise ValueError('Index of column %s is out of date.'%key)
+        return grp['perm'], grp['fences'][()], int(grp.attrs['fence_step'])
+
+    def is_indexed(self,key):
+        try:
+            self.sorted_index(key)
+        except ValueError:
+            return False
+        return True
+
+    def read_sorted(self,key,start=None,stop=None,step=None):
+        """Read rows in order of the sorted index of column key.
+
+        start, stop and step are positions in that order, e.g., step=-1 reads
+        rows in descending order.
+        """
+        perm,_,_ = self.sorted_index(key)
+        pos = np.arange(*slice(start,stop,step).indices(self.nrows))
+        if pos.size == 0:
+            return np.empty(0,dtype=self.dtype)
+        lo = int(pos.min())
+        return self.take(self.read_dataset(perm,lo,int(pos.max())+1)[pos-lo])
+
+    def read_range(self,key,low=None,high=None):
+        """Read rows with low <= key < high in ascending order of key.
+
+        Fences of the sorted index bound the positions of the range within
+        fence_step rows, then only rows at these positions are read.
+        """
+        perm,fences,fence_step = self.sorted_index(key)
+        p0 = 0
+        p1 = self.nrows
+        if low is not None:
+            p0 = max(0, int(np.searchsorted(fences,low,side='left'))-1)*fence_step
+        if high is not None:
+            p1 = min(self.nrows, int(np.searchsorted(fences,high,side='left'))*fence_step)
+        rows = self.read_sorted(key,p0,max(p0,p1))
+        mask = np.ones(rows.size,dtype=bool)
+        if low is not None:
+            mask &= rows[key] >= low
+        if high is not None:
+            mask &= rows[key] < high
+        return rows[mask]
+
+    def read_categories(self):
+        if categories_group not in self.group:
+            return {}
+        return dict((cname, cats[()]) for cname,cats in iteritems(self.group[categories_group]) if cname in self.cols)
+
+    def write_categories(self,categories):
+        grp = self.group.require_group(categories_group)
+        for cname,cats in iteritems(categories):
+            if cname not in grp:
+                grp.create_dataset(cname,data=np.asarray(cats,dtype=string_dtype(cats)))
+
+    def column_capacity(self,cname):
+        col = self.cols[cname]
+        if col.maxshape[0] is None:
+            return np.inf
+        return int(col.maxshape[0])
+
+    def close(self):
+        self.file.close()
+
+    def get_checkpoint(self):
+        if checkpoint_name in self.group.attrs:
+            return json.loads(self.group.attrs[checkpoint_name])
+        return None
+
+    def set_checkpoint(self,checkpoint):
+        self.group.attrs[checkpoint_name] = json.dumps(checkpoint)
+        self.file.flush()
+
+    def truncate(self,nrows):
+        for key,col in iteritems(self.cols):
+            discard_chunks(self.cache, self.chunk_key(key), self.chunklen(key), nrows, self.nrows)
+            if col.maxshape[0] is None:
+                col.resize((nrows,))
+        for values,offsets in self.jagged_cols.values():
+            size = int(offsets[nrows])
+            discard_chunks(self.cache, self.file_key+(offsets.name,), self.dataset_chunklen(offsets), nrows, offsets.size)
+            discard_chunks(self.cache, self.file_key+(values.name,), self.dataset_chunklen(values), size, values.size)
+            offsets.resize((nrows+1,))
+            values.resize((size,))
+        self.nrows = nrows
+        self.group.attrs['nrows'] = self.nrows
+
+    def chunklen(self,key):
+        return self.dataset_chunklen(self.cols[key])
+
+    def dataset_chunklen(self,col):
+        if col.chunks:
+            return col.chunks[0]
+        return max(1, default_chunk_size_bytes//col.dtype.itemsize)
+
+    def chunk_key(self,key):
+        return self.file_key + (self.cols[key].name,)
+
+    def append(self,rows,jagged=None):
+        """Append rows, and rows of jagged columns given as jagged_array.
+        """
         if self.writable and (self.nrows < self.nrows_max):
             n = rows.size
             t = self.nrows
-            for key in rows.dtype.fields:
-                self.cols[key][t:t+n] = rows[key][:]
+            for key in rows.dtype.names:
+                if self.cols[key].size < t+n:
+                    self.cols[key].resize((t+n,))
+            # rows are transposed into column buffers of bounded size, one slab at a time.
+            nslab = max(1, default_scratch_size_bytes//max(1,rows.dtype.itemsize))
+            for a in range(0,n,nslab):
+                m = min(nslab,n-a)
+                cols = records_to_columns(rows[a:a+m],self.buffers.columns('append',m,rows.dtype))
+                for key,col in iteritems(cols):
+                    self.cols[key][t+a:t+a+m] = col
+            for key in rows.dtype.names:
+                discard_chunks(self.cache, self.chunk_key(key), self.chunklen(key), t, t+n)
+            for key,arr in iteritems(jagged or {}):
+                values,offsets = self.jagged_cols[key]
+                arr  = arr.compact()
+                base = int(offsets[t])
+                offsets.resize((t+n+1,))
+                offsets[t+1:] = arr.offsets[1:]+base
+                values.resize((base+arr.values.size,))
+                values[base:] = arr.values
+                discard_chunks(self.cache, self.file_key+(offsets.name,), self.dataset_chunklen(offsets), t, t+n+1)
+                discard_chunks(self.cache, self.file_key+(values.name,), self.dataset_chunklen(values), base, values.size)
             self.nrows += n
             self.group.attrs['nrows'] = self.nrows
         else:
             raise StandardError("Table is read-only or out of space.")
 
-    def read(self,start=None,stop=None,step=None):
-        start = max(start,0)
-        step  = max(step, 1)
-        if not stop:
-            stop = self.nrows
-        stop  = min(stop, self.nrows)
-        n = int(np.ceil(1.0*(stop-start)/step))
-        arr = np.empty(n,dtype=self.dtype)
-        for key,val in iteritems(self.cols):
-            arr[key] = val[start:stop:step]
+def sort_run(args):
+    """Sort rows start:stop of column key into run-sorted keys and permutation (process pool worker).
+    """
+    fname,tname,key,start,stop,keys_path,perm_path = args
+    with h5py.File(fname,'r') as f:
+        k = f[tname][key][start:stop]
+    order = np.argsort(k,kind='stable')
+    keys  = np.load(keys_path,mmap_mode='r+')
+    perm  = np.load(perm_path,mmap_mode='r+')
+    keys[start:stop] = k[order]
+    perm[start:stop] = order+start
+    keys.flush()
+    perm.flush()
+
+def merge_partition(args):
+    """Merge slices of sorted runs holding keys of one partition (process pool worker).
+
+    Slices are concatenated in row order and sorted stably, so that equal keys
+    stay in row order. Sorting concatenated sorted runs is close to linear.
+    """
+    keys_path,perm_path,sorted_keys_path,sorted_perm_path,bounds,offset = args
+    keys = np.load(keys_path,mmap_mode='r')
+    perm = np.load(perm_path,mmap_mode='r')
+    k = np.concatenate([keys[lo:hi] for lo,hi in bounds])
+    p = np.concatenate([perm[lo:hi] for lo,hi in bounds])
+    order = np.argsort(k,kind='stable')
+    sorted_keys = np.load(sorted_keys_path,mmap_mode='r+')
+    sorted_perm = np.load(sorted_perm_path,mmap_mode='r+')
+    sorted_keys[offset:offset+k.size] = k[order]
+    sorted_perm[offset:offset+k.size] = p[order]
+    sorted_keys.flush()
+    sorted_perm.flush()
+
+def run_position(keys,perm,k,r):
+    """Position of the first (key, row) of a sorted run not below (k, r).
+    """
+    lo = int(np.searchsorted(keys,k,side='left'))
+    hi = int(np.searchsorted(keys,k,side='right'))
+    return lo+int(np.searchsorted(perm[lo:hi],r,side='left'))
+
+def create_sorted_index(fname,tname,key,nprocs=None,fence_step=default_fence_step,tmpdir=None):
+    """Create sorted index of column key of HDF5 table tname in file fname.
+
+    The index is a permutation of rows in ascending order of key, ties in row
+    order, and the keys at every fence_step-th position of that order, saved in
+    the index_group subgroup of the table (see hdf5_table.read_sorted).
+
+    Runs of rows are sorted in parallel by a pool of nprocs processes. Keys
+    sampled from the sorted runs split the key range into partitions, which the
+    pool merges in parallel. Runs and partitions are exchanged through memory
+    mapped files in a temporary directory under tmpdir. Splitters are pairs of
+    key and row, so that partitions stay balanced whatever the number of rows
+    of equal keys.
+    """
+    tab   = hdf5_table(fname=fname,tname=tname,mode='r',cache=None)
+    nrows = tab.nrows
+    ctype = np.dtype(tab.dtype[key].str)
+    tab.close()
+    if nrows == 0:
+        write_sorted_index(fname,tname,key,np.empty(0,dtype=ctype),np.empty(0,dtype='int64'),fence_step)
+        return
+    nprocs = nprocs or default_nprocs
+    # a worker holds a run of keys, their sorted copy and the permutation.
+    nrun  = int(max(1, min(np.ceil(1.0*nrows/nprocs), 8*default_buffer_size_bytes//(2*ctype.itemsize+8))))
+    runs  = [(t,min(nrows,t+nrun)) for t in range(0,nrows,nrun)]
+    tmp   = mkdtemp(prefix='tabio_index_',dir=tmpdir)
+    try:
+        paths = [path.join(tmp,name+'.npy') for name in ['keys','perm','sorted_keys','sorted_perm']]
+        for p,dtype in zip(paths,[ctype,'int64',ctype,'int64']):
+            np.lib.format.open_memmap(p,mode='w+',dtype=dtype,shape=(nrows,))
+        with Pool(nprocs) as pool:
+            pool.map(sort_run,[(fname,tname,key,a,b,paths[0],paths[1]) for a,b in runs])
+            keys = np.load(paths[0],mmap_mode='r')
+            perm = np.load(paths[1],mmap_mode='r')
+            # splitters are (key, row) pairs, so that rows of equal keys are
+            # split between partitions as well, in row order.
+            # up to 64 samples per run and partition, index_sample_size in total.
+            nparts = len(runs)
+            nsamples = max(1, min(64*nparts, index_sample_size//nparts))
+            picks  = [a+np.linspace(0,b-a-1,min(b-a,nsamples)).astype('int64') for a,b in runs]
+            sample_keys = np.concatenate([keys[i] for i in picks])
+            sample_rows = np.concatenate([perm[i] for i in picks])
+            order = np.lexsort((sample_rows,sample_keys))[(np.arange(1,nparts)*sample_keys.size)//nparts]
+            split_keys,split_rows = sample_keys[order],sample_rows[order]
+            cuts = [np.concatenate([[a],[a+run_position(keys[a:b],perm[a:b],k,r) for k,r in zip(split_keys,split_rows)],[b]]) for a,b in runs]
+            jobs   = []
+            offset = 0
+            for i in range(nparts):
+                bounds = [(int(c[i]),int(c[i+1])) for c in cuts]
+                jobs.append((paths[0],paths[1],paths[2],paths[3],bounds,offset))
+                offset += sum(hi-lo for lo,hi in bounds)
+            pool.map(merge_partition,jobs)
+        write_sorted_index(fname,tname,key,np.load(paths[2],mmap_mode='r'),np.load(paths[3],mmap_mode='r'),fence_step)
+    finally:
+        rmtree(tmp)
+
+def write_sorted_index(fname,tname,key,sorted_keys,sorted_perm,fence_step):
+    """Save permutation and fences of the sorted index of column key, replacing any previous one.
+    """
+    nrows = sorted_perm.size
+    with h5py.File(fname,'a') as f:
+        grp = f[tname].require_group(index_group)
+        if key in grp:
+            del grp[key]
+        grp = grp.create_group(key)
+        if nrows > 0:
+            perm = grp.create_dataset('perm',shape=(nrows,),dtype='int64',chunks=True,compression='lzf')
+        else:
+            perm = grp.create_dataset('perm',shape=(0,),dtype='int64')
+        nbuf = max(1, default_buffer_size_bytes//8)
+        for t in range(0,nrows,nbuf):
+            perm[t:t+nbuf] = sorted_perm[t:t+nbuf]
+        grp.create_dataset('fences',data=np.asarray(sorted_keys[::fence_step]))
+        grp.attrs['nrows']      = nrows
+        grp.attrs['fence_step'] = fence_step
+
+def pytables_description(row_dtype,categories):
+    """PyTables description of rows, with EnumCol of labels for categorical columns.
+    """
+    desc = {}
+    for i,cname in enumerate(row_dtype.names):
+        ctype = np.dtype(row_dtype[cname].str)
+        if cname in categories and len(categories[cname]) > 0:
+            labels = [c.decode('utf-8') for c in categories[cname]]
+            desc[cname] = tables.EnumCol(tables.Enum(labels), labels[0], base=ctype.name, pos=i)
+        else:
+            desc[cname] = tables.Col.from_dtype(ctype, pos=i)
+    return desc
+
+def enum_categories(enum):
+    """Labels of PyTables enum indexed by their values, None unless values are 0, 1, 2, ...
+    """
+    items = sorted(enum, key=lambda item: item[1])
+    if [value for _,value in items] != list(range(len(items))):
+        return None
+    labels = [name.encode('utf-8') for name,_ in items]
+    return np.array(labels, dtype=string_dtype(labels))
+
+class pytables_table(table):
+    def __init__(self,node=None,fname=None,tname=None,mode="r",row_dtype=None,expectedrows=None,filters=None,cache=default_cache,categories=None):
+        """Native PyTables table.
+
+        The table is created with row_dtype if it does not exist and mode is writable.
+        Categorical columns are created as EnumCol of their labels (see pytables_description).
+        Chunks of PyTables tables hold whole rows, so the chunk cache keeps
+        records instead of single columns.
+        """
+        if node is None:
+            mode = pytables_file_mode[mode]
+            tpath = path.join('/',tname)
+            self.file = tables.open_file(fname,mode)
+            if mode != 'r' and row_dtype is not None and tpath not in self.file:
+                tdir,tname = path.split(tpath)
+                if filters is None:
+                    filters = tables.Filters(complevel=5,complib='blosc')
+                node = self.file.create_table(create_groups(self.file, tdir),tname,
+                    description=pytables_description(np.dtype(row_dtype),categories or {}),
+                    expectedrows=expectedrows or 10000,
+                    filters=filters)
+            else:
+                node = self.file.get_node(tpath)
+        else:
+            self.file = node._v_file
+        self.node     = node
+        self.cache    = cache
+        self.file_key = file_key(self.file.filename)
+        self.dtype    = node.dtype
+        self.rowsize  = node.rowsize
+        self.nrows    = node.nrows
+        self.cols     = dict((cname, getattr(node.cols, cname)) for cname in node.colnames)
+        self.categories = {}
+        for cname in node.colnames:
+            if node.coltypes[cname] == 'enum':
+                cats = enum_categories(node.get_enum(cname))
+                if cats is not None:
+                    self.categories[cname] = cats
+
+    def close(self):
+        self.file.close()
+
+    def get_checkpoint(self):
+        if checkpoint_name in self.node.attrs:
+            return json.loads(self.node.attrs[checkpoint_name])
+        return None
+
+    def set_checkpoint(self,checkpoint):
+        self.node.attrs[checkpoint_name] = json.dumps(checkpoint)
+        self.node.flush()
+
+    def truncate(self,nrows):
+        discard_chunks(self.cache, self.chunk_key(), self.chunklen(), nrows, self.nrows)
+        self.node.truncate(nrows)
+        self.nrows = self.node.nrows
+
+    def chunklen(self,key=None):
+        return self.node.chunkshape[0]
+
+    def chunk_key(self,key=None):
+        return self.file_key + (self.node._v_pathname,)
+
+    def load(self,key,start,stop,step=1):
+        return self.node.read(start,stop,step)
+
+    def read_column(self,key,start=None,stop=None,step=None):
+        """Read column key, or whole records if key is None.
+
+        Records are cached as a whole, so columns are fields of cached records.
+        """
+        if key is None:
+            return table.read_column(self,None,start,stop,step)
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        if self.cache is None and step > 0:
+            return self.node.read(start,stop,step,field=key)
+        return table.read_column(self,None,start,stop,step)[key]
+
+    def take_column(self,key,rows):
+        if key is None:
+            return table.take_column(self,None,rows)
+        return table.take_column(self,None,rows)[key]
+
+    def read(self,start=None,stop=None,step=None,out=None):
+        """Read rows start:stop:step, into the first rows of buffer out if it is given.
+
+        Without chunk cache, PyTables reads records directly into out.
+        """
+        if out is None:
+            return self.read_column(None,start,stop,step)
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        arr = output_buffer(out,len(range(start,stop,step)),self.dtype)
+        if self.cache is None and step > 0:
+            if arr.size > 0:
+                self.node.read(start,stop,step,out=arr)
+        else:
+            arr[...] = self.read_column(None,start,stop,step)
         return arr
 
+    def take(self,indices):
+        rows,inverse = self.unique_rows(indices)
+        return self.take_column(None,rows)[inverse]
+
+    def read_sorted(self,key,start=None,stop=None,step=None):
+        """Read rows in order of the completely sorted index of column key.
+        """
+        return self.node.read_sorted(key,start=start,stop=stop,step=step)
+
+    def append(self,rows):
+        t = self.nrows
+        self.node.append(rows)
+        self.nrows = self.node.nrows
+        discard_chunks(self.cache, self.chunk_key(), self.chunklen(), t, self.nrows)
+
+dtype_metadata_key = b'tabio.dtype'
+categories_metadata_key = b'tabio.categories'
+def arrow_schema(row_dtype,categories=None,jagged=None):
+    """Arrow schema of rows of row_dtype, which keeps row_dtype and labels of categorical columns in its metadata.
+
+    Jagged columns are large lists, i.e., lists with int64 offsets.
+    """
+    fields = []
+    for cname in row_dtype.names:
+        ctype = row_dtype[cname]
+        if ctype.kind == 'S':
+            fields.append(pyarrow.field(cname, pyarrow.binary()))
+        elif ctype.kind == 'U':
+            fields.append(pyarrow.field(cname, pyarrow.string()))
+        else:
+            fields.append(pyarrow.field(cname, pyarrow.from_numpy_dtype(ctype)))
+    for cname,ctype in iteritems(jagged or {}):
+        fields.append(pyarrow.field(cname, pyarrow.large_list(pyarrow.from_numpy_dtype(np.dtype(ctype)))))
+    metadata = {dtype_metadata_key:json.dumps([(cname, row_dtype[cname].str) for cname in row_dtype.names])}
+    if categories:
+        metadata[categories_metadata_key] = json.dumps(categories_to_json(categories))
+    return pyarrow.schema(fields, metadata=metadata)
+
+def schema_jagged(schema):
+    """dtypes of values of list columns of fixed-width values of Arrow schema.
+    """
+    jagged = {}
+    for field in schema:
+        if pyarrow.types.is_list(field.type) or pyarrow.types.is_large_list(field.type):
+            try:
+                ctype = np.dtype(field.type.value_type.to_pandas_dtype())
+            except NotImplementedError:
+                continue
+            if ctype.kind in 'biuf':
+                jagged[field.name] = ctype
+    return jagged
+
+def schema_categories(schema):
+    """Labels of categorical columns kept in the metadata of Arrow schema.
+    """
+    if schema.metadata and categories_metadata_key in schema.metadata:
+        return categories_from_json(json.loads(schema.metadata[categories_metadata_key]))
+    return {}
+
+def schema_dtype(schema):
+    """Row dtype of Arrow schema.
+
+    Schemas written by tabio restore the exact dtype, including the length of
+    strings. Columns of other schemas that are not of fixed width are skipped.
+    """
+    if schema.metadata and dtype_metadata_key in schema.metadata:
+        return np.dtype([tuple(f) for f in json.loads(schema.metadata[dtype_metadata_key])])
+    fields = []
+    for field in schema:
+        try:
+            ctype = np.dtype(field.type.to_pandas_dtype())
+        except NotImplementedError:
+            continue
+        if ctype.kind in 'biuf':
+            fields.append((field.name, ctype))
+    return np.dtype(fields)
+
+def arrow_columns(rows, schema, jagged=None):
+    """Arrow arrays of fields of rows and of jagged columns.
+
+    Fields are made contiguous once, then numeric columns, and values and
+    offsets of jagged columns, are wrapped by Arrow without copying.
+    """
+    columns = []
+    for field in schema:
+        if jagged and field.name in jagged:
+            arr = jagged[field.name].compact()
+            columns.append(pyarrow.LargeListArray.from_arrays(pyarrow.array(arr.offsets), pyarrow.array(arr.values)))
+        else:
+            columns.append(pyarrow.array(np.ascontiguousarray(rows[field.name]), type=field.type))
+    return columns
+
+class arrow_batches_table(table):
+    """Table stored in batches of rows, i.e., Parquet row groups or Arrow record batches.
+
+    Each uniform batch is a chunk in the chunk cache. Writers buffer rows and
+    write batches of row_group_size rows, which is by default the number of rows
+    in a read buffer of convert_table.
+    """
+    def init_read(self,fname,batch_sizes,schema,cache):
+        self.cache    = cache
+        self.file_key = file_key(fname)
+        self.dtype    = schema_dtype(schema)
+        self.categories = schema_categories(schema)
+        self.jagged   = schema_jagged(schema)
+        self.rowsize  = self.dtype.itemsize
+        self.cols     = dict((cname, None) for cname in self.dtype.names)
+        self.offsets  = np.cumsum([0]+list(batch_sizes))
+        self.nrows    = int(self.offsets[-1])
+        self.writable = False
+
+    def init_write(self,fname,mode,row_dtype,row_group_size,categories=None,jagged=None):
+        mode = pytables_file_mode[mode]
+        if mode == 'a' and path.exists(fname):
+            raise NotImplementedError("Appending to %s files is not supported."%type(self).__name__)
+        self.cache    = None
+        self.file_key = file_key(fname)
+        self.dtype    = np.dtype(row_dtype)
+        self.rowsize  = self.dtype.itemsize
+        self.cols     = dict((cname, None) for cname in self.dtype.names)
+        self.schema   = arrow_schema(self.dtype,categories,jagged)
+        self.categories = dict(categories or {})
+        self.jagged   = dict(jagged or {})
+        self.nrows    = 0
+        self.writable = True
+        self.buffered = []
+        self.nbuffered = 0
+        self.row_group_size = row_group_size or max(1, default_buffer_size_bytes//self.rowsize)
+
+    def chunklen(self,key):
+        sizes = np.diff(self.offsets)
+        if sizes.size > 0 and np.all(sizes[:-1] == sizes[0]) and sizes[-1] <= sizes[0]:
+            return int(sizes[0])
+        return None
+
+    def chunk_key(self,key):
+        return self.file_key + (key,)
+
+    def load(self,key,start,stop,step=1):
+        ctype = self.dtype[key]
+        if stop <= start:
+            return np.empty(0, dtype=ctype)
+        first = int(np.searchsorted(self.offsets, start, side='right')) - 1
+        last  = int(np.searchsorted(self.offsets, stop, side='left'))
+        parts = [self.load_batch(i, key).to_numpy(zero_copy_only=False) for i in range(first, last)]
+        col = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        b0 = self.offsets[first]
+        return col[start-b0:stop-b0:step].astype(ctype, copy=False)
+
+    def jagged_chunks(self,key,rows):
+        return np.searchsorted(self.offsets, rows, side='right') - 1
+
+    def load_jagged(self,key,start,stop):
+        parts = []
+        if stop > start:
+            first = int(np.searchsorted(self.offsets, start, side='right')) - 1
+            last  = int(np.searchsorted(self.offsets, stop, side='left'))
+            for i in range(first, last):
+                arr = self.load_batch(i, key)
+                if isinstance(arr, pyarrow.ChunkedArray):
+                    arr = arr.combine_chunks()
+                b0, b1 = self.offsets[i], self.offsets[i+1]
+                batch = jagged_array(arr.values.to_numpy(zero_copy_only=False), np.asarray(arr.offsets))
+                parts.append(batch[max(start,b0)-b0:min(stop,b1)-b0])
+        return concatenate_jagged(parts, self.jagged[key])
+
+    def append(self,rows,jagged=None):
+        """Append rows, and rows of jagged columns given as jagged_array.
+        """
+        if not self.writable:
+            raise IOError("Table is read-only.")
+        self.buffered.append((rows, jagged or {}))
+        self.nbuffered += rows.size
+        self.nrows     += rows.size
+        if self.nbuffered >= self.row_group_size:
+            rows, jagged = self.concatenate_buffered()
+            n = rows.size//self.row_group_size*self.row_group_size
+            for t in range(0, n, self.row_group_size):
+                self.write_batch(rows[t:t+self.row_group_size], dict((k, a[t:t+self.row_group_size]) for k,a in iteritems(jagged)))
+            self.buffered  = [(rows[n:], dict((k, a[n:]) for k,a in iteritems(jagged)))]
+            self.nbuffered = rows.size-n
+
+    def concatenate_buffered(self):
+        rows   = np.concatenate([r for r,_ in self.buffered])
+        jagged = dict((k, concatenate_jagged([j[k] for _,j in self.buffered], ctype)) for k,ctype in iteritems(self.jagged))
+        return rows, jagged
+
+    def flush(self):
+        if self.writable and self.nbuffered > 0:
+            self.write_batch(*self.concatenate_buffered())
+            self.buffered  = []
+            self.nbuffered = 0
+
+class parquet_table(arrow_batches_table):
+    def __init__(self,fname=None,mode='r',row_dtype=None,compression=None,row_group_size=None,cache=default_cache,categories=None,jagged=None):
+        """Apache Parquet file.
+
+        compression - codec of all columns, or dict of codecs per column. It may
+                      be given as 'COLUMN:CODEC,...' where a codec without column
+                      applies to the other columns.
+        """
+        if pytables_file_mode[mode] == 'r':
+            self.file = parquet.ParquetFile(fname)
+            meta = self.file.metadata
+            self.init_read(fname, [meta.row_group(i).num_rows for i in range(meta.num_row_groups)], self.file.schema_arrow, cache)
+        else:
+            self.init_write(fname, mode, row_dtype, row_group_size, categories, jagged)
+            self.writer = parquet.ParquetWriter(fname, self.schema, compression=parse_codecs(compression, self.dtype.names) or 'snappy')
+
+    def load_batch(self,i,key):
+        return self.file.read_row_group(i, columns=[key]).column(0)
+
+    def write_batch(self,rows,jagged=None):
+        self.writer.write_table(pyarrow.Table.from_arrays(arrow_columns(rows, self.schema, jagged), schema=self.schema), row_group_size=rows.size)
+
+    def close(self):
+        if self.writable:
+            self.flush()
+            self.writer.close()
+        else:
+            self.file.close()
+
+class arrow_table(arrow_batches_table):
+    def __init__(self,fname=None,mode='r',row_dtype=None,compression=None,row_group_size=None,cache=default_cache,categories=None,jagged=None):
+        """Apache Arrow IPC file (Feather V2).
+
+        The file is memory mapped, so uncompressed numeric columns are read without copying.
+        compression - codec of the whole file, 'lz4' or 'zstd'.
+        """
+        if pytables_file_mode[mode] == 'r':
+            self.file   = pyarrow.memory_map(fname, 'r')
+            self.reader = arrow_ipc.open_file(self.file)
+            self.init_read(fname, [self.reader.get_batch(i).num_rows for i in range(self.reader.num_record_batches)], self.reader.schema, cache)
+        else:
+            self.init_write(fname, mode, row_dtype, row_group_size, categories, jagged)
+            self.writer = arrow_ipc.new_file(fname, self.schema, options=arrow_ipc.IpcWriteOptions(compression=compression))
+
+    def load_batch(self,i,key):
+        return self.reader.get_batch(i).column(key)
+
+    def write_batch(self,rows,jagged=None):
+        self.writer.write_batch(pyarrow.RecordBatch.from_arrays(arrow_columns(rows, self.schema, jagged), schema=self.schema))
+
+    def close(self):
+        if self.writable:
+            self.flush()
+            self.writer.close()
+        else:
+            self.file.close()
+
+def parse_codecs(compression,names):
+    """Codec of each column from 'COLUMN:CODEC,...', a codec without column applies to the others.
+    """
+    if not compression or isinstance(compression,dict):
+        return compression
+    codecs = {}
+    default = None
+    for item in compression.split(','):
+        if ':' in item:
+            cname,codec = item.split(':')
+            codecs[cname] = codec
+        else:
+            default = item
+    if not codecs:
+        return default
+    return dict((cname, codecs.get(cname, default or 'snappy')) for cname in names)
+
+npy_sidecar_name = '.tabio.json'
+def npy_header(dtype,nrows,size=None):
+    """Header of a 1-D .npy file of nrows rows of dtype.
+
+    The header is padded to size bytes, by default with room for nrows to grow
+    to any 64-bit integer, so that it can be rewritten in place after appends.
+    """
+    d = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }"%(np.lib.format.dtype_to_descr(np.dtype(np.dtype(dtype).str)), nrows)
+    if size is None:
+        size = int(np.ceil((10+len(d)+21)/64.0))*64
+    if 10+len(d)+1 > size:
+        raise IOError("No room in .npy header for %d rows."%nrows)
+    return np.lib.format.magic(1,0) + struct.pack('<H', size-10) + (d.ljust(size-11)+'\n').encode('latin1')
+
+class npy_table(table):
+    def __init__(self,fname=None,mode='r',row_dtype=None,categories=None):
+        """Directory of one 1-D .npy file per column.
+
+        Columns are memory mapped with np.load(mmap_mode='r'), so that reads
+        and takes touch only the pages of the rows requested. Column order,
+        labels of categorical columns and checkpoints are kept in a sidecar
+        file in the directory.
+        """
+        mode = pytables_file_mode[mode]
+        self.fname    = fname
+        self.writable = mode != 'r'
+        if mode == 'w' and path.isdir(fname):
+            for f in listdir(fname):
+                if f.endswith('.npy') or f == npy_sidecar_name:
+                    remove(path.join(fname, f))
+        if self.writable and not path.isdir(fname):
+            makedirs(fname)
+        self.sidecar = self.read_sidecar()
+        if 'columns' in self.sidecar:
+            names = self.sidecar['columns']
+        elif row_dtype is not None:
+            names = list(np.dtype(row_dtype).names)
+        else:
+            names = sorted(path.splitext(f)[0] for f in listdir(fname) if f.endswith('.npy'))
+        self.cols  = {}
+        self.files = {}
+        self.dtype = []
+        self.nrows = np.inf
+        for cname in names:
+            cpath = self.column_path(cname)
+            if self.writable and not path.exists(cpath):
+                with open(cpath, 'wb') as f:
+                    f.write(npy_header(row_dtype[cname], 0))
+            if self.writable:
+                f = open(cpath, 'r+b')
+                np.lib.format.read_magic(f)
+                shape,_,ctype = np.lib.format.read_array_header_1_0(f)
+                self.files[cname] = (f, f.tell())
+                self.nrows = int(min(self.nrows, shape[0]))
+            else:
+                self.cols[cname] = np.load(cpath, mmap_mode='r')
+                ctype = self.cols[cname].dtype
+                self.nrows = int(min(self.nrows, self.cols[cname].size))
+            self.dtype.append((cname, ctype))
+        if self.nrows == np.inf:
+            self.nrows = 0
+        self.dtype   = np.dtype(self.dtype)
+        self.rowsize = self.dtype.itemsize
+        if self.writable:
+            self.cols = dict((cname, None) for cname in names)
+            self.sidecar['columns'] = names
+            if categories and 'categories' not in self.sidecar:
+                self.sidecar['categories'] = categories_to_json(categories)
+            self.write_sidecar()
+        self.categories = categories_from_json(self.sidecar.get('categories', {}))
+
+    def column_path(self,cname):
+        return path.join(self.fname, cname+'.npy')
+
+    def read_sidecar(self):
+        try:
+            with open(path.join(self.fname, npy_sidecar_name), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_sidecar(self):
+        tmp = path.join(self.fname, npy_sidecar_name+'.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.sidecar, f)
+        replace(tmp, path.join(self.fname, npy_sidecar_name))
+
+    def load(self,key,start,stop,step=1):
+        if self.writable:
+            return np.load(self.column_path(key), mmap_mode='r')[start:stop:step]
+        return self.cols[key][start:stop:step]
+
+    def take(self,indices):
+        """Read rows at indices by fancy indexing of the mapped columns.
+        """
+        rows,inverse = self.unique_rows(indices)
+        arr = np.empty(inverse.size,dtype=self.dtype)
+        for key in self.cols:
+            arr[key] = self.load(key,0,self.nrows)[rows][inverse]
+        return arr
+
+    def resize(self,nrows):
+        """Set number of rows in the header of each column and trim data after them.
+        """
+        for cname,(f,offset) in iteritems(self.files):
+            f.seek(0)
+            f.write(npy_header(self.dtype[cname], nrows, offset))
+            f.truncate(offset+nrows*self.dtype[cname].itemsize)
+            f.flush()
+        self.nrows = nrows
+
+    def append(self,rows):
+        if not self.writable:
+            raise IOError("Table is read-only.")
+        for cname,(f,offset) in iteritems(self.files):
+            f.seek(offset+self.nrows*self.dtype[cname].itemsize)
+            f.write(np.ascontiguousarray(rows[cname], dtype=self.dtype[cname]).tobytes())
+        self.resize(self.nrows+rows.size)
+
+    def truncate(self,nrows):
+        self.resize(nrows)
+
+    def get_checkpoint(self):
+        return self.sidecar.get(checkpoint_name)
+
+    def set_checkpoint(self,checkpoint):
+        self.sidecar[checkpoint_name] = checkpoint
+        self.write_sidecar()
+
+    def close(self):
+        for f,_ in self.files.values():
+            f.close()
+        self.files = {}
+
+tree_blocks = {}
+def read_tree_block(args):
+    """Read entries of a tree into a shared memory block.
+
+    Worker of the process pool of tree_table. Trees are kept open by the worker
+    across blocks so that each process parses the file metadata only once.
+    """
+    fname,tname,cols,start,stop,step,shm_name,offset,dtype = args
+    if (fname,tname) not in tree_blocks:
+        tfile = ROOT.TFile(fname,'read')
+        tree_blocks[(fname,tname)] = (tfile, tfile.Get(tname))
+    _,tree = tree_blocks[(fname,tname)]
+    rows = root_numpy.tree2array(tree, branches=cols, start=start, stop=stop, step=step)
+    shm  = shared_memory.SharedMemory(name=shm_name)
+    buf  = np.ndarray((rows.size,), dtype=dtype, buffer=shm.buf, offset=offset)
+    buf[:] = rows
+    del buf
+    shm.close()
+    return rows.size
+
 class tree_table(table):
-    def __init__(self,tree=None,fname=None,tname=None,mode="read",row_dtype=None):
+    def __init__(self,tree=None,fname=None,tname=None,mode="read",row_dtype=None,parallel=None,nprocs=None,cache=default_cache,categories=None):
+        """Table implemented with ROOT TTree.
+
+        String columns are stored in char string branches. Categorical columns are
+        stored as branches of codes, with their labels in the user info of the tree.
+        Variable-length branches are read as jagged columns (see read_jagged).
+
+        parallel - parallel read mode, 'imt' to decompress baskets with ROOT implicit
+                   multi-threading, or 'process' to read disjoint entry clusters with
+                   a pool of processes (see root_parallel_mode).
+        nprocs   - number of threads or processes, all cores by default.
+        cache    - chunk cache of baskets used by take and reads smaller than
+                   a chunk, None to bypass it.
+        """
         mode = root_file_mode[mode]
+        self.mode      = mode
+        self.cache     = cache
         self.open_file = False
+        self.fname     = fname
+        self.tname     = tname
+        self.parallel  = None
+        self.nprocs    = nprocs or default_nprocs
+        self.pool      = None
+        if parallel:
+            self.parallel = root_parallel_mode[parallel.lower()]
+        if self.parallel == 'imt':
+            ROOT.ROOT.EnableImplicitMT(self.nprocs)
         if not tree:
             if path.exists(fname):
-                tfile = TFile(fname,mode)
+                tfile = ROOT.TFile(fname,mode)
                 tree  = tfile.Get(tname)
             else:
-                tfile = TFile(fname,'create')
-            if not isinstance(tree,TTree): # tree doesn't exist. create it.
+                tfile = ROOT.TFile(fname,'create')
+            if not isinstance(tree,ROOT.TTree): # tree doesn't exist. create it.
                 tdir,tname = path.split(tname)
-                tree = TTree(tname, '')
+                tree = ROOT.TTree(tname, '')
                 for bname, btype in iteritems(np.dtype(row_dtype).fields):
-                    btype = btype[0].name
-                    addr  = array(numpy_type_to_python_type[btype],[0])
+                    btype = numpy_type_name(btype[0])
+                    addr  = array(numpy_type_to_python_type[btype],[0]*(np.dtype(row_dtype)[bname].itemsize+1 if btype == 'string' else 1))
                     tree.Branch(bname,addr,'%s/%s'%(bname,numpy_type_to_root_type[btype]))
                 if tdir:
                     parent_obj = tfile
@@ -466,31 +2176,200 @@ class tree_table(table):
                     while dirs:
                         d = dirs.pop(0)
                         if d not in ['','/']:
-                            parent_obj = TDirectoryFile(d,'','',parent_obj)
+                            parent_obj = ROOT.TDirectoryFile(d,'','',parent_obj)
                     tree.SetDirectory(tfile.GetDirectory(tdir))
                 else:
                     tree.SetDirectory(tfile)
             self.open_file = True
+        else:
+            tfile = tree.GetDirectory().GetFile()
         self.tree  = tree
         self.file  = tfile
+        self.file_key = file_key(tfile.GetName())
         self.cols  = {}
         self.dtype = []
         self.rowsize = 0
         self.nrows   = np.inf
+        self.jagged  = {}
         for branch in tree.GetListOfBranches():
             bname  = branch.GetName()
+            leaf   = branch.GetLeaf(bname)
+            if leaf and leaf.GetLeafCount():
+                self.jagged[bname] = np.dtype(root_type_name_to_numpy_type[leaf.GetTypeName()])
+                continue
             barray = branch_array(branch=branch)
             self.cols[bname] = barray
             self.dtype.append((bname,np.dtype(barray.dtype)))
             self.rowsize += np.dtype(barray.dtype).itemsize
             self.nrows = int(min(self.nrows, barray.size))
         self.dtype=np.dtype(self.dtype)
+        if categories and self.mode != 'read':
+            self.set_user_info(categories_name, categories_to_json(categories))
+        self.categories = categories_from_json(self.get_user_info(categories_name) or {})
+
+    def chunklen(self,key):
+        """Number of entries per basket of branch key.
+        """
+        return max(1, self.cols[key].branch.GetBasketSize()//self.cols[key].dtype.itemsize)
 
-    def read(self,start=None,stop=None,step=None,cols=None,condition=None):
-        return tree2array(self.tree, branches=cols, selection=condition, start=start, stop=stop, step=step)
+    def chunk_key(self,key):
+        return self.file_key + (self.tree.GetName(), key)
+
+    def load(self,key,start,stop,step=1):
+        return root_numpy.tree2array(self.tree, branches=[key], start=start, stop=stop, step=step)[key]
+
+    def load_jagged(self,key,start,stop):
+        """Read variable-length branch key, flattened into values and offsets.
+
+        Counts are read from the count branch, values of all entries at once by
+        TTree::Draw into its value buffer, so that no object is built per entry.
+        Values pass through float64 there, so 64-bit integers, which it cannot
+        represent exactly, are read through root_numpy object arrays instead.
+        """
+        dtype = self.jagged[key]
+        if dtype.kind in 'iu' and dtype.itemsize == 8:
+            return jagged_from_objects(root_numpy.tree2array(self.tree, branches=[key], start=start, stop=stop)[key], dtype)
+        branch = self.tree.GetBranch(key).GetLeaf(key).GetLeafCount().GetBranch()
+        counts = root_numpy.tree2array(self.tree, branches=[branch.GetName()], start=start, stop=stop)[branch.GetName()]
+        offsets = np.zeros(counts.size+1, dtype='int64')
+        np.cumsum(counts, out=offsets[1:])
+        n = int(offsets[-1])
+        if n == 0:
+            return jagged_array(np.empty(0, dtype=self.jagged[key]), offsets)
+        self.tree.SetEstimate(n+1)
+        m = int(self.tree.Draw(key, '', 'goff', stop-start, start))
+        if m != n:
+            raise IOError('Branch %s has %d values in entries %d:%d, %d counted.'%(key, m, start, stop, n))
+        buf = self.tree.GetV1()
+        buf.reshape((n,))
+        return jagged_array(np.frombuffer(buf, dtype='float64', count=n).astype(self.jagged[key]), offsets)
+
+    def read(self,start=None,stop=None,step=None,cols=None,condition=None,out=None):
+        """Read rows start:stop:step, into the first rows of buffer out if it is given.
+
+        Only the process pool reads into out without an intermediate array,
+        root_numpy allocates the rows it converts, which are then copied.
+        """
+        if cols is None and self.jagged:
+            cols = list(self.dtype.names)
+        if self.parallel == 'process' and condition is None and self.fname:
+            return self.read_parallel(start,stop,step,cols,out)
+        if out is not None:
+            rows = self.read(start,stop,step,cols,condition)
+            arr  = output_buffer(out,rows.size,rows.dtype)
+            arr[...] = rows
+            return arr
+        if self.cache is not None and condition is None and cols is None:
+            # only small reads go through the basket cache, sequential reads
+            # convert all branches in a single tree2array call.
+            start,stop,step = slice(start,stop,step).indices(self.nrows)
+            if len(range(start,stop,step))*self.rowsize <= default_chunk_size_bytes:
+                return table.read(self,start,stop,step)
+        return root_numpy.tree2array(self.tree, branches=cols, selection=condition, start=start, stop=stop, step=step)
+
+    def clusters(self,start,stop):
+        """Boundaries of entry clusters between start and stop.
+        """
+        bounds = [start]
+        it = self.tree.GetClusterIterator(start)
+        it.Next()
+        entry = it.Next()
+        while start < entry < stop:
+            bounds.append(int(entry))
+            entry = it.Next()
+        bounds.append(stop)
+        return bounds
+
+    def read_parallel(self,start=None,stop=None,step=None,cols=None,out=None):
+        """Read rows with a pool of processes.
+
+        Entry clusters between start and stop are grouped into blocks of about
+        equal size. Each worker decompresses its blocks and writes the rows into
+        one shared memory buffer at their final offsets, which is then copied
+        into out, or a new array if out is None.
+        """
+        start,stop,step = slice(start,stop,step).indices(self.nrows)
+        n = int(max(0, np.ceil(1.0*(stop-start)/step)))
+        dtype = root_numpy.tree2array(self.tree, branches=cols, start=0, stop=1).dtype
+        arr = output_buffer(out,n,dtype)
+        if n == 0:
+            return arr
+        bounds = self.clusters(start,stop)
+        nblocks = min(len(bounds)-1, 4*self.nprocs)
+        bounds = [bounds[int(round(i*(len(bounds)-1.0)/nblocks))] for i in range(nblocks+1)]
+        shm  = shared_memory.SharedMemory(create=True, size=max(1, n*dtype.itemsize))
+        jobs = []
+        for b0,b1 in zip(bounds[:-1],bounds[1:]):
+            b0 = start + int(np.ceil(1.0*(b0-start)/step))*step
+            if b0 < b1:
+                jobs.append((self.fname,self.tname,cols,b0,b1,step,shm.name,((b0-start)//step)*dtype.itemsize,dtype))
+        try:
+            if self.pool is None:
+                self.pool = Pool(self.nprocs)
+            self.pool.map(read_tree_block, jobs)
+            arr[...] = np.ndarray((n,), dtype=dtype, buffer=shm.buf)
+        finally:
+            shm.close()
+            shm.unlink()
+        return arr
+
+    def get_user_info(self,name):
+        obj = self.tree.GetUserInfo().FindObject(name)
+        if obj:
+            return json.loads(obj.GetTitle())
+        return None
+
+    def set_user_info(self,name,value):
+        """Save value as JSON in user info of the tree.
+
+        It is written to file together with the tree, i.e., by close or set_checkpoint.
+        """
+        info = self.tree.GetUserInfo()
+        obj  = info.FindObject(name)
+        if obj:
+            info.Remove(obj)
+        obj = ROOT.TNamed(name, json.dumps(value))
+        ROOT.SetOwnership(obj, False)
+        info.Add(obj)
+
+    def get_checkpoint(self):
+        return self.get_user_info(checkpoint_name)
+
+    def set_checkpoint(self,checkpoint):
+        """Save checkpoint in user info of the tree and write the tree with it,
+        so that an interrupted conversion resumes from the last checkpoint.
+        """
+        self.set_user_info(checkpoint_name, checkpoint)
+        if self.mode != 'read':
+            self.tree.AutoSave('SaveSelf')
+
+    def truncate(self,nrows):
+        """Trees cannot drop entries, truncation only succeeds if there is nothing to drop.
+        """
+        if nrows != self.nrows:
+            raise IOError('Tree %s has %d entries, %d of them committed. Entries of ROOT trees cannot be dropped, '
+                'convert again in create mode.'%(self.tree.GetName(),self.nrows,nrows))
+
+    def close(self):
+        self.close_pool()
+        if self.open_file:
+            if self.mode != 'read':
+                self.file.Write()
+            self.file.Close()
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def append(self,rows):
-        self.tree = array2tree(rows, tree=self.tree)
+        t = self.tree.GetEntries()
+        self.tree = root_numpy.array2tree(rows, tree=self.tree)
+        self.nrows = int(self.tree.GetEntries())
+        for key in rows.dtype.fields:
+            if key in self.cols:
+                discard_chunks(self.cache, self.chunk_key(key), self.chunklen(key), t, t+rows.size)
 
 def print_table(t,title):
     print("{:-^80}".format(' '+title+' '))
@@ -506,7 +2385,10 @@ def print_table(t,title):
             pass
     print("{:-^80}".format(""))
 
+import_stats['tabio'] = (time()-import_tic, rss_bytes()-import_rss)
+
 if __name__ == '__main__': #executed from command line
+    profile_import = False
     try:
         args    = []
         options = {}
@@ -515,17 +2397,33 @@ if __name__ == '__main__': #executed from command line
                 options['output_format'] = arg.split('=')[1]
             elif '-f=' in arg:
                 options['output_format'] = arg.split('=')[1]
+            elif '--selection=' in arg:
+                options['selection'] = arg.split('=',1)[1]
+            elif '-e=' in arg:
+                options['selection'] = arg.split('=',1)[1]
+            elif arg in ['--incremental','-i']:
+                options['incremental'] = True
+            elif '--categorical=' in arg:
+                options['categorical'] = arg.split('=')[1].split(',')
+            elif '-k=' in arg:
+                options['categorical'] = arg.split('=')[1].split(',')
+            elif '--compression=' in arg:
+                options['compression'] = arg.split('=')[1]
+            elif '-c=' in arg:
+                options['compression'] = arg.split('=')[1]
+            elif arg == '--profile-import':
+                profile_import = True
             elif '-s=' in arg:
                 start,stop,step = arg.split('=')[1].split(':')
-                options['start'] = start
-                options['stop']  = stop
-                options['step']  = step
+                options['start'] = int(start) if start else None
+                options['stop']  = int(stop) if stop else None
+                options['step']  = int(step) if step else None
             elif '--start=' in arg:
-                options['start'] = arg.split('=')[1]
+                options['start'] = int(arg.split('=')[1])
             elif '--stop=' in arg:
-                options['stop'] = arg.split('=')[1]
+                options['stop'] = int(arg.split('=')[1])
             elif '--step=' in arg:
-                options['step'] = arg.split('=')[1]
+                options['step'] = int(arg.split('=')[1])
             elif '--mode=' in arg:
                 options['mode'] = arg.split('=')[1]
             elif '-m=' in arg:
@@ -534,6 +2432,14 @@ if __name__ == '__main__': #executed from command line
                 options['samplerate'] = float(arg.split('=')[1])
             elif '-r=' in arg:
                 options['samplerate'] = float(arg.split('=')[1])
+            elif '--parallel=' in arg:
+                options['parallel'] = arg.split('=')[1]
+            elif '-p=' in arg:
+                options['parallel'] = arg.split('=')[1]
+            elif '--nprocs=' in arg:
+                options['nprocs'] = int(arg.split('=')[1])
+            elif '-n=' in arg:
+                options['nprocs'] = int(arg.split('=')[1])
             else:
                 args.append(arg)
         try:
@@ -548,5 +2454,7 @@ if __name__ == '__main__': #executed from command line
         except:
             options['output_fname'] = args[1]
         convert_table(input_fname, input_tname, **options)
+        if profile_import:
+            print_import_stats()
     except IndexError:
         print(__doc__)
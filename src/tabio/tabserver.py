@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""Serve tables to local processes through a Unix socket.
+
+The socket is accessible to its owner only, and clients authenticate with a
+random key that the server saves in socket_path.key (mode 0600).
+
+The server keeps tables open and reads them through one chunk cache shared by
+all its clients. Results are handed over in shared memory blocks that clients
+map without copying (Linux, where POSIX shared memory lives in /dev/shm).
+
+Syntax:
+  tabserver.py [options] socket_path
+
+Options:
+  -h  print this message.
+  -c  chunk cache size in bytes, suffix as 'k', 'm' and 'g' are supported.
+  -k  key file (default: socket_path.key).
+
+Client:
+  from tabserver import table_client
+  tab = table_client(socket_path).open_table(fname, tname)
+  rows = tab.read(start, stop)
+  rows = tab.take(indices)
+  rows = tab.read_where(selection, start, stop)
+
+"""
+import os
+import sys
+import mmap
+import threading
+import numpy as np
+from os import path
+from getopt import gnu_getopt
+from signal import signal, SIGINT
+from multiprocessing.connection import Listener, Client
+from multiprocessing import shared_memory, AuthenticationError
+from chunkcache import default_cache, set_cache_size
+from tabio import table, open_table, select_rows, output_buffer
+
+shm_dir = '/dev/shm'
+key_suffix = '.key'
+
+def write_authkey(fname):
+    """Write a new random authentication key to fname, readable by its owner only.
+    """
+    key = os.urandom(32)
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.fchmod(fd, 0o600)
+        os.write(fd, key)
+    finally:
+        os.close(fd)
+    return key
+
+def read_authkey(fname):
+    with open(fname, 'rb') as f:
+        return f.read()
+
+class table_server(object):
+    def __init__(self, address, cache=default_cache, keyfile=None):
+        """Table server listening on Unix socket address.
+
+        keyfile - file the authentication key is written to, address+key_suffix by default.
+        """
+        self.address = address
+        self.keyfile = keyfile or address+key_suffix
+        self.cache   = cache
+        self.tables  = {}
+        self.lock    = threading.Lock()
+
+    def get_table(self, fname, tname):
+        """Open table, or return it if it is already open, with its lock.
+        """
+        key = (path.realpath(fname), tname)
+        with self.lock:
+            if key not in self.tables:
+                self.tables[key] = (open_table(fname, tname, cache=self.cache), threading.Lock())
+            return self.tables[key]
+
+    def handle(self, request):
+        op = request['op']
+        if op == 'stats':
+            return {'stats':self.cache.stats(), 'tables':len(self.tables)}
+        tab, lock = self.get_table(request['fname'], request['tname'])
+        with lock:
+            if op == 'open':
+                return {'nrows':tab.nrows, 'dtype':tab.dtype, 'categories':tab.categories}
+            elif op == 'read':
+                return tab.read(request['start'], request['stop'], request['step'])
+            elif op == 'take':
+                return tab.take(request['indices'])
+            elif op == 'select':
+                return select_rows(tab.read(request['start'], request['stop'], request['step']), request['selection'], tab.categories)
+            else:
+                raise ValueError(u'unsupported request {}.'.format(op))
+
+    def serve_client(self, conn):
+        """Answer requests of one client until it disconnects.
+
+        Arrays are copied once into a new shared memory block. The block is
+        unlinked as soon as the client acknowledges that it is done mapping it,
+        whether mapping succeeded or not. Any other reply ends the connection.
+        """
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    result = self.handle(request)
+                except Exception as e:
+                    conn.send({'error':u'{}: {}'.format(type(e).__name__, e)})
+                    continue
+                if not isinstance(result, np.ndarray):
+                    conn.send(result)
+                    continue
+                if result.nbytes == 0:
+                    conn.send({'shm':None, 'size':result.size, 'dtype':result.dtype})
+                    continue
+                shm = shared_memory.SharedMemory(create=True, size=result.nbytes)
+                try:
+                    np.ndarray(result.shape, dtype=result.dtype, buffer=shm.buf)[:] = result
+                    conn.send({'shm':shm.name, 'size':result.size, 'dtype':result.dtype})
+                    ack = conn.recv()
+                    if not (isinstance(ack, dict) and ack.get('op') == 'ack'):
+                        return
+                finally:
+                    shm.close()
+                    shm.unlink()
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        authkey  = write_authkey(self.keyfile)
+        listener = Listener(self.address, family='AF_UNIX', authkey=authkey)
+        os.chmod(self.address, 0o600)
+        print(u'Serving tables on {} (key in {}).'.format(self.address, self.keyfile))
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError):
+                    continue
+                t = threading.Thread(target=self.serve_client, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            listener.close()
+
+def map_block(name, size, dtype):
+    """Map shared memory block as read-only array without copying.
+
+    The mapping lives as long as the array.
+    """
+    fd = os.open(path.join(shm_dir, name.lstrip('/')), os.O_RDONLY)
+    try:
+        mm = mmap.mmap(fd, size*dtype.itemsize, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    return np.frombuffer(mm, dtype=dtype, count=size)
+
+class table_client(object):
+    def __init__(self, address, keyfile=None):
+        """Client of table server listening on Unix socket address.
+
+        keyfile - authentication key of the server, address+key_suffix by default.
+        """
+        self.conn = Client(address, family='AF_UNIX', authkey=read_authkey(keyfile or address+key_suffix))
+        self.lock = threading.Lock()
+
+    def request(self, **request):
+        with self.lock:
+            self.conn.send(request)
+            reply = self.conn.recv()
+            if isinstance(reply, dict) and 'error' in reply:
+                raise RuntimeError(reply['error'])
+            if isinstance(reply, dict) and 'shm' in reply:
+                if reply['shm'] is None:
+                    return np.empty(reply['size'], dtype=reply['dtype'])
+                try:
+                    return map_block(reply['shm'], reply['size'], reply['dtype'])
+                finally:
+                    self.conn.send({'op':'ack'})
+            return reply
+
+    def open_table(self, fname, tname):
+        return remote_table(self, fname, tname)
+
+    def stats(self):
+        return self.request(op='stats')
+
+    def close(self):
+        self.conn.close()
+
+class remote_table(table):
+    def __init__(self, client, fname, tname):
+        """Table served by a table server.
+
+        Rows returned are read-only arrays mapped from shared memory.
+        """
+        self.client  = client
+        self.fname   = fname
+        self.tname   = tname
+        info = client.request(op='open', fname=fname, tname=tname)
+        self.nrows   = info['nrows']
+        self.dtype   = info['dtype']
+        self.categories = info['categories']
+        self.rowsize = self.dtype.itemsize
+        self.cols    = dict((cname, None) for cname in self.dtype.names)
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        rows = self.client.request(op='read', fname=self.fname, tname=self.tname, start=start, stop=stop, step=step)
+        if out is None:
+            return rows
+        arr = output_buffer(out, rows.size, rows.dtype)
+        arr[...] = rows
+        return arr
+
+    def take(self, indices):
+        return self.client.request(op='take', fname=self.fname, tname=self.tname, indices=np.asarray(indices))
+
+    def read_where(self, selection, start=None, stop=None, step=None):
+        return self.client.request(op='select', fname=self.fname, tname=self.tname, selection=selection, start=start, stop=stop, step=step)
+
+def handler(signal_rcvd, frame):
+    print('\nAbort. Goodbye!')
+    sys.exit(0)
+
+if __name__ == '__main__':
+    signal(SIGINT, handler)
+    opts, args = gnu_getopt(sys.argv[1:], 'hc:k:')
+    keyfile = None
+    for opt, val in opts:
+        if opt == '-h':
+            print(__doc__)
+            sys.exit()
+        elif opt == '-k':
+            keyfile = val
+        elif opt == '-c':
+            if val.lower().endswith('k'):
+                set_cache_size(int(val[:-1]) * 1024)
+            elif val.lower().endswith('m'):
+                set_cache_size(int(val[:-1]) * 1024**2)
+            elif val.lower().endswith('g'):
+                set_cache_size(int(val[:-1]) * 1024**3)
+            else:
+                set_cache_size(int(val))
+    table_server(args[0], keyfile=keyfile).serve_forever()